@@ -1,29 +1,30 @@
-import datetime
 import json
 import logging
 import sys
+import threading
+import time
 
 import flask
 from cryptography.fernet import Fernet
-from flask import redirect, request
+from flask import g, redirect, request
 from slack_bolt import App
 from waitress import serve
 
+from rsc import metrics
+from rsc.authStore import AuthStore
 
-def purge_expired():
-    global auth_list
-    popping = []
-    for auth_id in auth_list:
-        if (
-            auth_list[auth_id]["from"] + config["auth_server"]["expiry"]
-            > datetime.datetime.now().timestamp()
-        ):
-            popping.append(auth_id)
-    for auth_id in popping:
-        auth_list.pop(auth_id)
-    logger.debug(
-        f"Got {len(auth_list)} auths from file and purged {len(popping)} expired auths"
-    )
+
+def check_token():
+    # Returns an error response if the request isn't from the bot
+    auth_header = request.headers.get("Authorization")
+    if auth_header:
+        token = auth_header.split(" ")[1]
+    else:
+        return flask.jsonify({"error": "No token provided"}), 401
+
+    if token != config["auth_server"]["query_token"]:
+        return flask.jsonify({"error": "Invalid token"}), 403
+    return None
 
 
 def redirect_page(link):
@@ -56,6 +57,30 @@ else:
 
 app = flask.Flask(__name__)
 
+# Signalled whenever a new auth is added to the list
+auth_condition = threading.Condition()
+
+request_seconds = metrics.Histogram(
+    "filebutler_auth_server_request_seconds",
+    "Time taken to answer each auth server endpoint",
+    metrics.LATENCY_BUCKETS,
+)
+
+
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+
+
+@app.after_request
+def record_time(response):
+    request_seconds.observe(
+        time.perf_counter() - g.start,
+        endpoint=request.endpoint or "unknown",
+        status=response.status_code,
+    )
+    return response
+
 
 @app.route("/", methods=["GET"])  # type: ignore
 def index():
@@ -63,29 +88,62 @@ def index():
         return f.read()
 
 
+@app.route("/metrics", methods=["GET"])  # type: ignore
+def return_metrics():
+    error = check_token()
+    if error:
+        return error
+
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+
 @app.route("/api/v1/authList", methods=["GET"])  # type: ignore
 def return_auth_list():
-    auth_header = request.headers.get("Authorization")
-    if auth_header:
-        token = auth_header.split(" ")[1]
-    else:
-        return flask.jsonify({"error": "No token provided"}), 401
+    error = check_token()
+    if error:
+        return error
 
-    if token != config["auth_server"]["query_token"]:
-        return flask.jsonify({"error": "Invalid token"}), 403
+    return flask.jsonify(auth_store.all()), 200
+
+
+@app.route("/api/v1/auth/<auth_id>", methods=["GET"])  # type: ignore
+def return_auth(auth_id):
+    # Look up a single ID rather than sending the whole list
+    error = check_token()
+    if error:
+        return error
+
+    auth = auth_store.get(auth_id)
+    if not auth:
+        return flask.jsonify({"error": "Not authenticated"}), 404
+    return flask.jsonify(auth), 200
 
-    # purge expired auths
-    purge_expired()
 
-    return flask.jsonify(auth_list), 200
+@app.route("/api/v1/authWait/<auth_id>", methods=["GET"])  # type: ignore
+def wait_for_auth(auth_id):
+    # Long poll that returns as soon as the given ID authenticates, or after the timeout
+    error = check_token()
+    if error:
+        return error
+
+    timeout = min(
+        float(request.args.get("timeout", 10)),
+        config["auth_server"].get("max_wait", 30),
+    )
+
+    with auth_condition:
+        auth_condition.wait_for(lambda: auth_store.get(auth_id), timeout=timeout)
+        auth = auth_store.get(auth_id)
+
+    if not auth:
+        return flask.jsonify({"error": "Not authenticated"}), 408
+    return flask.jsonify(auth), 200
 
 
 @app.route("/api/v1/authRequest/<en_request>", methods=["GET"])  # type: ignore
 def request_auth(en_request):
     auth_request = en_request.encode()
 
-    global auth_list
-
     # Decrypt the request and convert it from json to a dict
     request_d = json.loads(crypt.decrypt(auth_request).decode())
 
@@ -94,17 +152,12 @@ def request_auth(en_request):
         logger.debug("Parameter missing from request")
         return flask.jsonify({"error": "auth_request is malformed"}), 400
 
-    # Check if the requested ID is already on the list
-    if request_d["id"] in auth_list:
-        auth_list[request_d["id"]]["from"] = request_d["from"]
-        auth_list[request_d["id"]]["name"] = request_d["name"]
+    with auth_condition:
+        # Add the auth, or renew it if the ID is already on the list
+        auth_store.put(request_d)
 
-    else:
-        auth_list[request_d["id"]] = request_d
-
-    # Save the auth list to file
-    with open("temp_auths.json", "w") as f:
-        json.dump(auth_list, f)
+        # Wake up anyone waiting on this auth
+        auth_condition.notify_all()
 
     return redirect_page(link=deep_link)
 
@@ -115,14 +168,12 @@ if __name__ == "__main__":
     # Set up decryption
     crypt = Fernet(config["auth_server"]["request_key"].encode())
 
-    # Check if we have an existing auth list
-    try:
-        with open("temp_auths.json", "r") as f:
-            auth_list: dict = json.load(f)
-    except FileNotFoundError:
-        auth_list = {}
-
-    purge_expired()
+    # Load the existing auth list, importing the old JSON file if this is a fresh database
+    auth_store = AuthStore(
+        path=config["auth_server"].get("db_file", "temp_auths.db"),
+        expiry=config["auth_server"]["expiry"],
+        legacy_file="temp_auths.json",
+    )
 
     # Get the IDs associated with our Slack credentials for creating deep links
 
@@ -140,4 +191,10 @@ if __name__ == "__main__":
 
     deep_link = f"slack://app?team={team_id}&id={app_id}&tab=home"
 
-    serve(app, host=config["auth_server"]["host"], port=config["auth_server"]["port"])
+    # Long polls hold a thread each, so allow a few more than waitress' default
+    serve(
+        app,
+        host=config["auth_server"]["host"],
+        port=config["auth_server"]["port"],
+        threads=config["auth_server"].get("threads", 8),
+    )
@@ -0,0 +1,151 @@
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+# Local stand-ins for Slack (Web API and file downloads), TidyHQ, VirusTotal
+# and the auth server, all served from one port and routed by path.
+
+
+def make_contacts(count: int, slack_field: str) -> list[dict]:
+    contacts = []
+    for i in range(count):
+        contacts.append(
+            {
+                "id": i,
+                "first_name": "Bench",
+                "last_name": f"User{i}",
+                "status": "expired" if i % 3 == 0 else "active",
+                "custom_fields": [{"id": slack_field, "value": f"U{i:06d}"}],
+            }
+        )
+    return contacts
+
+
+def file_chunks(seed: str, size: int, chunk_size: int = 65536):
+    # Deterministic content so repeat downloads hash the same
+    # Generated a chunk at a time so large files don't inflate our own memory use
+    block = hashlib.sha256(seed.encode()).digest() * (chunk_size // 32)
+    for start in range(0, size, chunk_size):
+        yield block[: min(chunk_size, size - start)]
+
+
+class FakeServices:
+    def __init__(
+        self,
+        latency: float = 0,
+        contacts: int = 1000,
+        slack_field: str = "slack",
+        admins: list[str] | None = None,
+        malicious: set[str] | None = None,
+    ):
+        self.latency = latency
+        self.contacts = make_contacts(count=contacts, slack_field=slack_field)
+        self.admins = admins or []
+        self.malicious = malicious or set()
+        self.requests: dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self) -> "FakeServices":
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+
+    def count(self, route: str) -> None:
+        with self.lock:
+            self.requests[route] = self.requests.get(route, 0) + 1
+
+    def handler(self):
+        services = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, body, status=200):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self.route()
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                self.body = self.rfile.read(length) if length else b""
+                self.route()
+
+            def route(self):
+                if services.latency:
+                    time.sleep(services.latency)
+                url = urlparse(self.path)
+                parts = url.path.strip("/").split("/")
+
+                if parts[0] == "files":
+                    services.count("slack_file")
+                    return self.send_file(seed=parts[1], size=int(parts[2]))
+                if parts[:2] == ["v1", "contacts"]:
+                    services.count("tidyhq")
+                    return self.send_json(services.contacts)
+                if parts[:3] == ["api", "v3", "files"]:
+                    services.count("virustotal")
+                    return self.send_virustotal(file_hash=parts[3])
+                if parts[:3] == ["api", "v1", "auth"]:
+                    services.count("auth")
+                    return self.send_json({"error": "Not authenticated"}, 404)
+                if parts[0] == "api":
+                    services.count(f"slack:{parts[1]}")
+                    return self.send_slack(method=parts[1])
+                self.send_json({"error": "Not found"}, 404)
+
+            def send_file(self, seed: str, size: int):
+                self.send_response(200)
+                self.send_header("Content-Length", str(size))
+                self.end_headers()
+                for chunk in file_chunks(seed=seed, size=size):
+                    self.wfile.write(chunk)
+
+            def send_virustotal(self, file_hash: str):
+                if file_hash in services.malicious:
+                    return self.send_json(
+                        {
+                            "data": {
+                                "attributes": {
+                                    "reputation": -10,
+                                    "meaningful_name": "bench.exe",
+                                }
+                            }
+                        }
+                    )
+                self.send_json({"error": {"code": "NotFoundError"}}, 404)
+
+            def send_slack(self, method: str):
+                responses = {
+                    "auth.test": {"user": "butler", "team": "bench"},
+                    "chat.postMessage": {"ts": f"{time.time():.6f}"},
+                    "chat.update": {"ts": f"{time.time():.6f}"},
+                    "conversations.open": {"channel": {"id": "D000001"}},
+                    "usergroups.list": {
+                        "usergroups": [{"id": "GBENCH", "users": services.admins}]
+                    },
+                    "users.info": {"user": {"profile": {"display_name": "Bench"}}},
+                }
+                self.send_json({"ok": True, **responses.get(method, {})})
+
+        return Handler
@@ -0,0 +1,267 @@
+import argparse
+import functools
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from rsc import (  # noqa: E402
+    fileOperators,
+    formatters,
+    httpClient,
+    pipeline,
+    slackClient,
+    slackUtils,
+    tidyhq,
+    util,
+)
+
+from fake_services import FakeServices  # noqa: E402
+
+# Upload pipeline benchmarks, run against local fakes of every external service
+# so results are comparable between runs and machines.
+
+timings: dict[str, list[float]] = {}
+timings_lock = threading.Lock()
+
+
+def record(stage: str, seconds: float) -> None:
+    with timings_lock:
+        timings.setdefault(stage, []).append(seconds)
+
+
+def timed(stage: str, module, name: str) -> None:
+    # Replace module.name with a wrapper that records how long each call takes
+    original = getattr(module, name)
+
+    @functools.wraps(original)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            record(stage, time.perf_counter() - start)
+
+    setattr(module, name, wrapper)
+
+
+def instrument() -> None:
+    timed("entitlements", util, "check_entitlements")
+    timed("quota check", fileOperators, "reserve_file")
+    timed("download", fileOperators, "download_file")
+    timed("scan + save", pipeline, "finish_file")
+    timed("notify", pipeline, "report_file")
+    timed("slack call", slackUtils, "send")
+
+
+def percentile(values: list[float], pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def build_config(url: str, workdir: str, args) -> dict:
+    generous = 1000000
+    return {
+        "slack": {
+            "bot_token": "xoxb-bench",
+            "notification_channel": "CBENCH",
+            "unlimited_groups": ["GBENCH"],
+            "home_debounce": 0.05,
+            "home_max_delay": 0.2,
+            "notification_window": 0.05,
+            "dm_channel_file": f"{workdir}/dm_channels.json",
+            "rate_limits": {
+                method: generous
+                for method in [
+                    "chat.postMessage",
+                    "chat.update",
+                    "conversations.open",
+                    "usergroups.list",
+                    "users.info",
+                    "views.publish",
+                ]
+            },
+        },
+        "tidyhq": {
+            "token": "bench",
+            "api_url": url,
+            "ids": {"slack": "slack"},
+            "signup_url": "https://example.com",
+            "snapshot_file": f"{workdir}/tidyhq_contacts.json",
+        },
+        "virustotal": {
+            "api_key": "bench",
+            "api_url": url,
+            "cache_file": f"{workdir}/virustotal_cache.db",
+            "requests_per_minute": generous,
+            "scan_workers": 4,
+        },
+        "download": {
+            "folder_name": "butler",
+            "root_directory": f"{workdir}/root",
+            "max_file_size": args.file_size * 2,
+            "max_folder_size": args.file_size * args.files * 10,
+            "max_folder_files": args.files * 10,
+            "member_multiplier": 2,
+            "workers": args.workers,
+        },
+        "auth_server": {
+            "host": url.split("//")[1].split(":")[0],
+            "port": int(url.rsplit(":", 1)[1]),
+            "query_token": "bench",
+            "expiry": 86400,
+        },
+    }
+
+
+def make_event(url: str, user: str, index: int, files: int, size: int) -> dict:
+    return {
+        "type": "message",
+        "subtype": "file_share",
+        "user": user,
+        "channel": "D000001",
+        "ts": f"{index}.000001",
+        "files": [
+            {
+                "name": f"bench-{index}-{i}.bin",
+                "size": size,
+                "url_private": f"{url}/files/{user}-{index}-{i}/{size}",
+            }
+            for i in range(files)
+        ],
+    }
+
+
+def run_uploads(app, config: dict, url: str, users: list[str], args) -> float:
+    tidy_data = tidyhq.get()
+
+    def upload(index: int) -> None:
+        event = make_event(
+            url=url,
+            user=users[index % len(users)],
+            index=index,
+            files=args.files,
+            size=args.file_size,
+        )
+        start = time.perf_counter()
+        pipeline.handle_file_share(
+            event=event,
+            app=app,
+            config=config,
+            authed_slack_users=tidy_data["authed_slack_users"],
+            current_members=tidy_data["current_members"],
+            contacts=tidy_data["contacts"],
+        )
+        record("upload event", time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(upload, range(args.events)))
+    return time.perf_counter() - start
+
+
+def run_homes(app, config: dict, users: list[str], args) -> None:
+    tidy_data = tidyhq.get()
+    for i in range(args.homes):
+        start = time.perf_counter()
+        formatters.home(
+            user=users[i % len(users)],
+            config=config,
+            authed_slack_users=tidy_data["authed_slack_users"],
+            contacts=tidy_data["contacts"],
+            client=app.client,
+            current_members=tidy_data["current_members"],
+        )
+        record("home render", time.perf_counter() - start)
+
+
+def run_entitlements(app, config: dict, users: list[str], args) -> None:
+    tidy_data = tidyhq.get()
+    for i in range(args.homes):
+        # Every other lookup starts cold so both paths are measured
+        if i % 2:
+            util.invalidate_entitlements()
+        start = time.perf_counter()
+        util.check_entitlements(
+            user=users[i % len(users)],
+            config=config,
+            authed_slack_users_local=tidy_data["authed_slack_users"],
+            current_members_local=tidy_data["current_members"],
+            contacts=tidy_data["contacts"],
+            app=app,
+        )
+        record("entitlements (cold)" if i % 2 else "entitlements (warm)", time.perf_counter() - start)
+
+
+def report(elapsed: float, services: FakeServices, args) -> None:
+    print(f"{'stage':<22}{'count':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for stage, values in sorted(timings.items()):
+        print(
+            f"{stage:<22}{len(values):>8}"
+            f"{percentile(values, 50) * 1000:>10.2f}"
+            f"{percentile(values, 90) * 1000:>10.2f}"
+            f"{percentile(values, 99) * 1000:>10.2f}"
+            f"{max(values) * 1000:>10.2f}"
+        )
+
+    files = args.events * args.files
+    print()
+    print(f"Uploaded {files} files in {elapsed:.2f}s")
+    print(f"Throughput: {files / elapsed:.1f} files/s, {files * args.file_size / elapsed / 1e6:.1f} MB/s")
+    # ru_maxrss is in KiB on Linux
+    print(f"Peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB")
+    print(f"Requests to fake services: {dict(sorted(services.requests.items()))}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the File Butler upload path")
+    parser.add_argument("--events", type=int, default=20, help="file_share events to send")
+    parser.add_argument("--files", type=int, default=5, help="files per event")
+    parser.add_argument("--file-size", type=int, default=1000000, help="bytes per file")
+    parser.add_argument("--concurrency", type=int, default=4, help="events processed at once")
+    parser.add_argument("--workers", type=int, default=4, help="download.workers")
+    parser.add_argument("--latency", type=float, default=20, help="fake service latency in ms")
+    parser.add_argument("--contacts", type=int, default=1000, help="TidyHQ contacts")
+    parser.add_argument("--users", type=int, default=10, help="distinct uploading users")
+    parser.add_argument("--homes", type=int, default=200, help="home renders and entitlement checks")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="filebutler-bench-")
+    services = FakeServices(latency=args.latency / 1000, contacts=args.contacts)
+    # Contacts with index divisible by 3 are expired, so pick current members
+    users = [f"U{i:06d}" for i in range(1, args.contacts) if i % 3][: args.users]
+    services.admins = users[:1]
+    services.start()
+
+    try:
+        config = build_config(url=services.url, workdir=workdir, args=args)
+        httpClient.configure(config=config)
+        slackUtils.load_dm_channels(path=config["slack"]["dm_channel_file"])
+        tidyhq.full_sync(config=config)
+        app = SimpleNamespace(
+            client=slackClient.RateLimitedWebClient(
+                token=config["slack"]["bot_token"],
+                base_url=f"{services.url}/api/",
+                rate_limits=config["slack"]["rate_limits"],
+            )
+        )
+
+        instrument()
+        elapsed = run_uploads(app=app, config=config, url=services.url, users=users, args=args)
+        run_homes(app=app, config=config, users=users, args=args)
+        run_entitlements(app=app, config=config, users=users, args=args)
+        report(elapsed=elapsed, services=services, args=args)
+    finally:
+        services.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,30 @@
 import json
 import logging
-import os
 import sys
 import time
 from pprint import pprint
 from typing import Any, Literal
 
-import requests
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
 from slack_sdk.web.client import WebClient  # for typing
 from slack_sdk.web.slack_response import SlackResponse  # for typing
 
-from rsc import auth, fileOperators, formatters, slackUtils, strings, util, validators
+from rsc import (
+    auth,
+    fileOperators,
+    httpClient,
+    idempotency,
+    jobQueue,
+    metrics,
+    pipeline,
+    sharedState,
+    slackClient,
+    slackUtils,
+    strings,
+    tidyhq,
+    util,
+)
 
 # Load config
 with open("config.json") as config_file:
@@ -37,18 +49,60 @@ slack_logger = logging.getLogger("slack_bolt")
 slack_logger.setLevel(logging.INFO)
 
 # Connect to Slack
-app = App(token=config["slack"]["bot_token"], logger=slack_logger)
+# Calls are queued per method to stay inside Slack's rate limit tiers
+app = App(
+    client=slackClient.RateLimitedWebClient(
+        token=config["slack"]["bot_token"],
+        base_url=config["slack"].get("api_url", "https://slack.com/api/"),
+        rate_limits=config["slack"].get("rate_limits"),
+    ),
+    logger=slack_logger,
+)
+
+
+# Slack redelivers events that aren't acknowledged quickly enough, so remember
+# what we've seen recently and drop repeats before doing any work
+recent_events = idempotency.RecentSet(
+    name="event",
+    max_size=config["slack"].get("dedup_size", 10000),
+    ttl=config["slack"].get("dedup_ttl", 3600),
+)
+recent_files = idempotency.RecentSet(
+    name="file",
+    max_size=config["slack"].get("dedup_size", 10000),
+    ttl=config["slack"].get("dedup_ttl", 3600),
+)
 
 
 # Update the app home in certain circumstances
 @app.event("app_home_opened")  # type: ignore
 def app_home_opened(event: dict[str, Any], client: WebClient, ack) -> None:
     ack()
-    slackUtils.update_home(user=event["user"], client=client, config=config, authed_slack_users=authed_slack_users, contacts=contacts, current_members=current_members)  # type: ignore
+    tidy_data = tidyhq.get()
+    slackUtils.update_home(user=event["user"], client=app.client, config=config, authed_slack_users=tidy_data["authed_slack_users"], contacts=tidy_data["contacts"], current_members=tidy_data["current_members"])  # type: ignore
+
+
+# Keep the unlimited group cache in step with usergroup changes
+def subteam_changed(event, ack) -> None:
+    ack()
+    if event.get("subteam", {}).get("id", event.get("subteam_id")) in config["slack"][
+        "unlimited_groups"
+    ]:
+        logger.debug("Unlimited group changed, invalidating cache")
+        slackUtils.invalidate_unlimited()
+
+
+app.event("subteam_updated")(subteam_changed)
+app.event("subteam_members_changed")(subteam_changed)
 
 
 @app.event("message")
 def handle_message_events(body, logger, event, client):  # type: ignore
+    # Skip events Slack has already delivered to us
+    if body.get("event_id") and not recent_events.add(body["event_id"]):
+        logger.debug(f'Discarding redelivered event {body["event_id"]}')
+        return
+
     if event["type"] == "message" and not event.get("subtype", None):
         # Strip ts from the event so the message isn't sent in a thread
         event.pop("ts")
@@ -60,224 +114,68 @@ def handle_message_events(body, logger, event, client):  # type: ignore
         logger.debug("Discarding message event of wrong type")
         return
 
-    user: str = event["user"]
-
-    notification_ts = None
-
-    entitlements = util.check_entitlements(
-        user=user,
-        config=config,
-        authed_slack_users_local=authed_slack_users,
-        current_members_local=current_members,
-        contacts=contacts,
-        client=client,
-    )
-
-    # Users with no entitlements are given info on how to get them
-    if not entitlements["folder"]:
-        slackUtils.send(
-            app=app,
-            event=event,
-            message=strings.not_authed.format(signup_url=config["tidyhq"]["signup_url"])
-            + strings.not_authed_msg_addon,
-        )
-        # Let the notification channel know
-        ts = slackUtils.send(
-            app=app,
-            event=event,
-            message=strings.not_authed_admin.format(user=user),
-            channel=config["slack"]["notification_channel"],
-            ts=notification_ts,
-        )
-        if not notification_ts:
-            notification_ts = ts
+    # Skip files we're already handling from another event
+    files = idempotency.new_files(event=event, recent_files=recent_files)
+    if not files:
+        logger.debug("Discarding file_share event for files we've already seen")
+        return
 
+    # Hand the upload to the job queue so this handler returns straight away
+    try:
+        queued = jobQueue.enqueue(event={**event, "files": files})
+    except Exception:
+        # Bolt has already acknowledged the event so Slack won't send it again,
+        # handle it here instead of losing the upload
+        logger.exception("Could not queue upload, processing it directly")
+        process_upload(event={**event, "files": files})
         return
+    if not queued:
+        logger.debug("Discarding file_share event for files that are already queued")
 
-    # Check if the butler folder exists
-    if not os.path.exists(entitlements["folder"]):
-        slackUtils.send(
-            app=app,
-            event=event,
-            message=strings.no_butler_directory.format(
-                folder=config["download"]["folder_name"]
-            ),
-        )
 
-    # Create the folder if it doesn't exist
-    if not os.path.exists(entitlements["folder"]):
-        os.makedirs(entitlements["folder"])
-
-    for file in event["files"]:
-        filename = formatters.clean_filename(file["name"])
-
-        # Check if the file is a duplicate
-        if os.path.exists(f'{entitlements["folder"]}/{filename}'):
-            slackUtils.send(
-                app=app,
-                event=event,
-                message=strings.duplicate_file.format(
-                    folder=entitlements["folder"], file=filename
-                ),
-            )
-            continue
-
-        # Check if the file is too large
-        if not validators.check_size(
-            file_object=file, config=config, multiplier=entitlements["multiplier"]
-        ):
-            slackUtils.send(
-                app=app,
-                event=event,
-                message=strings.file_too_big.format(
-                    file=filename,
-                    size=formatters.file_size(file["size"]),
-                    max_file_size=formatters.file_size(
-                        num=(
-                            1000000000
-                            if config["download"]["max_file_size"]
-                            * entitlements["multiplier"]
-                            > 1000000000
-                            else config["download"]["max_file_size"]
-                            * entitlements["multiplier"]
-                        )
-                    ),
-                ),
-            )
-            continue
-
-        # Check if the folder is full
-        if not fileOperators.check_folder_eligibility(contacts=contacts, contact=authed_slack_users[user], config=config, user=user, multiplier=entitlements["multiplier"]):  # type: ignore
-            slackUtils.send(
-                app=app,
-                event=event,
-                message=strings.over_folder_limit.format(
-                    file=filename,
-                    max_folder_size=formatters.file_size(
-                        config["download"]["max_folder_size"]
-                        * entitlements["multiplier"]
-                    ),
-                    max_folder_files=config["download"]["max_folder_files"]
-                    * entitlements["multiplier"],
-                    butler_folder=config["download"]["folder_name"],
-                ),
-            )
-
-            # Let the notification channel know
-            ts = slackUtils.send(
-                app=app,
-                event=event,
-                message=strings.over_folder_limit_admin.format(
-                    file=filename,
-                    max_folder_size=formatters.file_size(
-                        config["download"]["max_folder_size"]
-                        * entitlements["multiplier"]
-                    ),
-                    max_folder_files=config["download"]["max_folder_files"]
-                    * entitlements["multiplier"],
-                    butler_folder=config["download"]["folder_name"],
-                    user=user,
-                ),
-                channel=config["slack"]["notification_channel"],
-                ts=notification_ts,
-                broadcast=True,
-            )
-
-            if not notification_ts:
-                notification_ts = ts
-
-            # Since the folder is full we can stop processing files
-            return
-
-        # Download the file
-        file_data = requests.get(
-            file["url_private"],
-            headers={"Authorization": f'Bearer {config["slack"]["bot_token"]}'},
-        )
+def process_upload(event: dict) -> None:
+    # Called by the job queue workers for each file_share event
+    # With --async the upload runs on the async engine's loop instead
+    if "--async" in sys.argv:
+        from rsc import asyncEngine
 
-        # Check the file with VirusTotal
-        virus_check = util.is_virus(content=file_data.content, config=config)
-
-        if virus_check:
-            # Explicitly warn the notification channel
-            ts = slackUtils.send(
-                app=app,
-                event=event,
-                message=strings.virus_found.format(
-                    user=user, file=filename, virus_name=virus_check
-                ),
-                channel=config["slack"]["notification_channel"],
-                ts=notification_ts,
-                broadcast=True,
-            )
-
-            if not notification_ts:
-                notification_ts = ts
-
-            # Let the user know there was a problem
-            slackUtils.send(
-                app=app,
-                event=event,
-                message=strings.virus_found,
-            )
-            # If one of the files is a virus stop processing files
-            return
-
-        # Save the file
-
-        with open(f'{entitlements["folder"]}/{filename}', "wb") as f:
-            f.write(file_data.content)
-
-        # Let the user know the file was saved
-        slackUtils.send(
-            app=app,
-            event=event,
-            message=strings.file_saved.format(
-                file=filename, folder=entitlements["folder"]
-            ),
-        )
+        handle_file_share = asyncEngine.run_file_share
+    else:
+        handle_file_share = pipeline.handle_file_share
 
-        # Send a message to the notification channel
-        ts = slackUtils.send(
-            app=app,
+    tidy_data = tidyhq.get()
+    with metrics.stage_seconds.time(stage="upload"):
+        handle_file_share(
             event=event,
-            message=strings.file_saved_admin.format(
-                file=filename, folder=entitlements["folder"], user=user
-            ),
-            channel=config["slack"]["notification_channel"],
-            ts=notification_ts,
-        )
-
-        # Update the app home
-        slackUtils.update_home(
-            user=user,
-            client=app.client,
+            app=app,
             config=config,
-            authed_slack_users=authed_slack_users,
-            contacts=contacts,
-            current_members=current_members,
+            authed_slack_users=tidy_data["authed_slack_users"],
+            current_members=tidy_data["current_members"],
+            contacts=tidy_data["contacts"],
         )
 
-        if not notification_ts:
-            notification_ts = ts
-
 
 @app.action("purge_folder")
 def delete_folder(ack, body, client):
     ack()
     user = body["user"]["id"]
+    tidy_data = tidyhq.get()
 
     entitlements = util.check_entitlements(
         user=user,
         config=config,
-        authed_slack_users_local=authed_slack_users,
-        current_members_local=current_members,
-        contacts=contacts,
-        client=client,
+        authed_slack_users_local=tidy_data["authed_slack_users"],
+        current_members_local=tidy_data["current_members"],
+        contacts=tidy_data["contacts"],
+        app=app,
     )
 
     # Delete the folder contents
-    if fileOperators.delete_folder_contents(folder=entitlements["folder"]):
+    with metrics.stage_seconds.time(stage="purge"):
+        deleted = fileOperators.delete_folder_contents(
+            folder=entitlements.folder, config=config
+        )
+    if deleted:
         slackUtils.send(app=app, event=body, message=strings.delete_success, dm=True)
 
         # Send a message to the notification channel
@@ -289,20 +187,21 @@ def delete_folder(ack, body, client):
         )
 
         # Update the app home
-        slackUtils.update_home(
+        slackUtils.schedule_home_update(
             user=user,
             client=app.client,
             config=config,
-            authed_slack_users=authed_slack_users,
-            contacts=contacts,
-            current_members=current_members,
+            authed_slack_users=tidy_data["authed_slack_users"],
+            contacts=tidy_data["contacts"],
+            current_members=tidy_data["current_members"],
         )
 
 
 @app.action("refresh_home")
 def refresh_home(ack, body, client):
     ack()
-    slackUtils.update_home(user=body["user"]["id"], client=client, config=config, authed_slack_users=authed_slack_users, contacts=contacts, current_members=current_members)  # type: ignore
+    tidy_data = tidyhq.get()
+    slackUtils.update_home(user=body["user"]["id"], client=app.client, config=config, authed_slack_users=tidy_data["authed_slack_users"], contacts=tidy_data["contacts"], current_members=tidy_data["current_members"])  # type: ignore
 
 
 @app.action("requesting_auth")
@@ -310,19 +209,19 @@ def user_off_requesting_auth(ack, body, logger):
     ack()
     user = body["user"]["id"]
 
-    count = 0
-    while count < 100 and not auth.check_auth(id=user, config=config):
-        time.sleep(0.1)
-        count += 1
+    # The auth server responds as soon as the user authenticates
+    authed = auth.wait_for_auth(id=user, config=config, timeout=10)
+    tidy_data = tidyhq.get()
+
     # Did the user manage to authenticate in time?
-    if auth.check_auth(id=user, config=config):
+    if authed:
         slackUtils.update_home(
             user=user,
             client=app.client,
             config=config,
-            authed_slack_users=authed_slack_users,
-            contacts=contacts,
-            current_members=current_members,
+            authed_slack_users=tidy_data["authed_slack_users"],
+            contacts=tidy_data["contacts"],
+            current_members=tidy_data["current_members"],
         )
     else:
         # Update the app home with a refresh button
@@ -330,13 +229,53 @@ def user_off_requesting_auth(ack, body, logger):
             user=user,
             client=app.client,
             config=config,
-            authed_slack_users=authed_slack_users,
-            contacts=contacts,
-            current_members=current_members,
+            authed_slack_users=tidy_data["authed_slack_users"],
+            contacts=tidy_data["contacts"],
+            current_members=tidy_data["current_members"],
             auth_step=2,
         )
 
 
+def run_async() -> None:
+    # Serve events from one asyncio loop instead of a Bolt thread per event
+    # Uploads still go through the job queue so they survive restarts, and the
+    # workers hand them back to the loop to download
+    from rsc import asyncEngine
+
+    asyncEngine.run(
+        app=app,
+        config=config,
+        events={
+            "app_home_opened": app_home_opened,
+            "subteam_updated": subteam_changed,
+            "subteam_members_changed": subteam_changed,
+            "message": handle_message_events,
+        },
+        actions={
+            "purge_folder": delete_folder,
+            "refresh_home": refresh_home,
+            "requesting_auth": user_off_requesting_auth,
+        },
+    )
+
+
+# Caches, leases and quota reservations shared with any other bot processes
+sharedState.configure(config=config)
+
+# Share pooled HTTP connections between all outbound requests
+httpClient.configure(config=config)
+
+# Expose timings and counters for scraping
+metrics.start_server(config=config)
+
+# Clear out blobs whose files were deleted while we weren't running
+fileOperators.collect_blobs(config=config)
+
+# Load the DM channels we've already opened
+slackUtils.load_dm_channels(
+    path=config["slack"].get("dm_channel_file", "dm_channels.json")
+)
+
 # Validate auth server config
 if not auth.validate_config(config=config):
     logging.critical("Auth server config is invalid, exiting...")
@@ -351,31 +290,29 @@ logger.info("Starting auth server...")
 # Launch auth_server.py as a forked subprocess
 auth.start_server(config=config, verbose="-v" in sys.argv)
 
-# Get all linked users from TidyHQ
-
-logger.info("Pulling TidyHQ contacts...")
-
-contacts: list[dict[str, Any]] = requests.get(
-    "https://api.tidyhq.com/v1/contacts/",
-    params={"access_token": config["tidyhq"]["token"]},
-).json()
-
-logger.debug(f"Received {len(contacts)} contacts")
-
-# Get info from TidyHQ
-authed_slack_users, current_members = util.get_tidy_info(config=config)
+# Get info from TidyHQ and keep it up to date in the background
+tidyhq.start_sync(config=config)
 
 # Get our user ID
 info = app.client.auth_test()
 logger.debug(f'Connected as @{info["user"]} to {info["team"]}')
 
+# Pull the unlimited group members and keep them up to date in the background
+slackUtils.start_unlimited_refresh(config=config, app=app)
+
 # Check if the auth server came up while we were getting data
 while not auth.check_server(config=config):
     logging.warning("Auth server is not up, waiting 5 seconds...")
     time.sleep(5)
 logger.info("Auth server is running")
 
+# Process queued uploads, including any left over from before a restart
+jobQueue.start(config=config, handler=process_upload)
+
 
 if __name__ == "__main__":
-    handler = SocketModeHandler(app, config["slack"]["app_token"])
-    handler.start()
+    if "--async" in sys.argv:
+        run_async()
+    else:
+        handler = SocketModeHandler(app, config["slack"]["app_token"])
+        handler.start()
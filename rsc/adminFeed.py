@@ -0,0 +1,89 @@
+import logging
+import threading
+import time
+
+from . import slackClient, slackUtils, strings
+
+# Set up logging
+
+logger = logging.getLogger("adminFeed")
+
+# Notifications for each user that are being collected into a single message
+bursts: dict[str, dict] = {}
+bursts_lock = threading.Lock()
+
+
+def notify(user: str, line: str, app, config: dict) -> None:
+    # Queue a line for the notification channel
+    # Lines for the same user are posted together, and later lines in the same
+    # burst update that message rather than posting a new one
+    burst_timeout = config["slack"].get("notification_burst_timeout", 60)
+
+    with bursts_lock:
+        now = time.monotonic()
+        burst = bursts.get(user)
+        if not burst or now - burst["last_line"] > burst_timeout:
+            burst = {"ts": None, "lines": [], "timer": None}
+            bursts[user] = burst
+        burst["lines"].append(line)
+        burst["last_line"] = now
+
+        if not burst["timer"]:
+            schedule(user=user, burst=burst, app=app, config=config)
+
+
+def schedule(user: str, burst: dict, app, config: dict) -> None:
+    # Must be called with bursts_lock held
+    burst["timer"] = threading.Timer(
+        config["slack"].get("notification_window", 5),
+        flush,
+        kwargs={"user": user, "burst": burst, "app": app, "config": config},
+    )
+    burst["timer"].daemon = True
+    burst["timer"].start()
+
+
+def render(user: str, lines: list[str], config: dict) -> str:
+    max_lines = config["slack"].get("notification_max_lines", 50)
+    text = strings.admin_summary.format(user=user, count=len(lines))
+    text += "\n" + "\n".join(lines[:max_lines])
+    if len(lines) > max_lines:
+        text += "\n" + strings.admin_summary_more.format(count=len(lines) - max_lines)
+    return text
+
+
+def flush(user: str, burst: dict, app, config: dict) -> None:
+    # The timer stays set while we post, so new lines wait for the next flush
+    with bursts_lock:
+        lines = list(burst["lines"])
+        ts = burst["ts"]
+
+    # A single line reads better as the original message
+    if len(lines) == 1:
+        text = lines[0]
+    else:
+        text = render(user=user, lines=lines, config=config)
+
+    # Timer threads start with a fresh context, so set the priority here
+    slackClient.current_priority.set(slackClient.ADMIN)
+    try:
+        if ts:
+            app.client.chat_update(
+                channel=config["slack"]["notification_channel"], ts=ts, text=text
+            )
+        else:
+            ts = slackUtils.send(
+                app=app,
+                event={"user": user},
+                message=text,
+                channel=config["slack"]["notification_channel"],
+            )
+    except Exception:
+        logger.exception(f"Could not post notifications for {user}")
+
+    with bursts_lock:
+        burst["ts"] = ts
+        burst["timer"] = None
+        # Pick up anything that arrived while we were posting
+        if len(burst["lines"]) > len(lines):
+            schedule(user=user, burst=burst, app=app, config=config)
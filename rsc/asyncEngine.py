@@ -0,0 +1,325 @@
+import asyncio
+import functools
+import hashlib
+import inspect
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
+from slack_bolt.async_app import AsyncApp
+
+from . import fileOperators, formatters, metrics, pipeline, validators, virustotal
+
+# Set up logging
+
+logger = logging.getLogger("asyncEngine")
+
+# Shared by every download so connections to Slack are kept alive and reused
+session: aiohttp.ClientSession | None = None
+download_slots: asyncio.Semaphore | None = None
+
+# The loop uploads run on, set once it's ready to take them from the job queue
+loop: asyncio.AbstractEventLoop | None = None
+ready = threading.Event()
+
+# Disk writes get their own threads so they don't queue behind Slack calls
+# waiting on rate limits in the default executor
+disk_executor: ThreadPoolExecutor | None = None
+
+
+async def on_disk(func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(
+        disk_executor, functools.partial(func, *args, **kwargs)
+    )
+
+
+async def download_file(
+    url: str, folder: str, config: dict, max_size: int
+) -> tuple[str, str]:
+    # Async version of fileOperators.download_file using the shared session
+    if not session:
+        raise Exception("Async engine not running")
+
+    fd, temp_path = await on_disk(fileOperators.create_temp_file, folder=folder)
+    file_hash = hashlib.sha256()
+    received = 0
+    try:
+        with os.fdopen(fd, "wb") as f:
+            async with session.get(
+                url,
+                headers={"Authorization": f'Bearer {config["slack"]["bot_token"]}'},
+            ) as r:
+                r.raise_for_status()
+                async for chunk in r.content.iter_chunked(
+                    config["download"].get("chunk_size", 1048576)
+                ):
+                    received += len(chunk)
+                    # Slack's reported size can't be trusted, so enforce the limit here too
+                    if received > max_size:
+                        raise fileOperators.FileTooLargeError(
+                            f"Download exceeded {max_size} bytes: {url}"
+                        )
+                    file_hash.update(chunk)
+                    await on_disk(f.write, chunk)
+    except BaseException:
+        fileOperators.discard_temp_file(temp_path)
+        raise
+
+    metrics.transfer_bytes.observe(received, direction="download")
+    logger.debug(f"Downloaded {received} bytes to {temp_path}")
+    return temp_path, file_hash.hexdigest()
+
+
+async def process_file(
+    file: dict,
+    check: tuple[str, dict],
+    index: int,
+    folder: str,
+    multiplier,
+    admin: bool,
+    config: dict,
+    stop: pipeline.StopMarker,
+) -> tuple[str, dict]:
+    # Async version of pipeline.process_file, given the file's check_files result
+    # Anything that can block on locks, SQLite or the disk is run in a thread so
+    # it doesn't hold up the event loop
+    status, details = check
+    if status != "ok":
+        return status, details
+    filename = details["file"]
+    if stop.stopped(index):
+        await asyncio.to_thread(
+            fileOperators.release_file, folder=folder, filename=filename
+        )
+        return "cancelled", details
+
+    try:
+        async with download_slots:  # type: ignore
+            with metrics.stage_seconds.time(stage="download"):
+                temp_path, file_hash = await download_file(
+                    url=file["url_private"],
+                    folder=folder,
+                    config=config,
+                    max_size=validators.max_file_size(
+                        config=config, multiplier=multiplier
+                    ),
+                )
+    except fileOperators.FileTooLargeError:
+        await asyncio.to_thread(
+            fileOperators.release_file, folder=folder, filename=filename
+        )
+        return "too_big", details
+    except Exception:
+        logger.exception(f"Could not download {filename}")
+        await asyncio.to_thread(
+            fileOperators.release_file, folder=folder, filename=filename
+        )
+        return "failed", details
+
+    details["temp_path"] = temp_path
+    details["hash"] = file_hash
+    try:
+        details["scan"] = await asyncio.to_thread(
+            virustotal.submit,
+            file_hash=file_hash,
+            config=config,
+            size=file["size"],
+            admin=admin,
+        )
+    except Exception:
+        logger.exception(f"Could not queue {filename} for a virus check")
+        await asyncio.to_thread(pipeline.abandon_file, details=details, folder=folder)
+        return "scan_failed", details
+    return "downloaded", details
+
+
+async def handle_file_share(
+    event: dict,
+    app,
+    config: dict,
+    authed_slack_users,
+    current_members,
+    contacts,
+) -> None:
+    # Async version of pipeline.handle_file_share
+    # Downloads and virus checks are awaited on the event loop rather than holding threads
+    entitlements = await asyncio.to_thread(
+        pipeline.prepare_upload,
+        event=event,
+        app=app,
+        config=config,
+        authed_slack_users=authed_slack_users,
+        current_members=current_members,
+        contacts=contacts,
+    )
+    if not entitlements:
+        return
+
+    notification_ts = None
+
+    # Reserve space in upload order, then download and scan concurrently
+    stop = pipeline.StopMarker(count=len(event["files"]))
+    checks = await asyncio.to_thread(
+        pipeline.check_files,
+        files=event["files"],
+        folder=entitlements.folder,
+        multiplier=entitlements.multiplier,
+        config=config,
+        stop=stop,
+    )
+    tasks = [
+        asyncio.create_task(
+            process_file(
+                file=file,
+                check=check,
+                index=index,
+                folder=entitlements.folder,
+                multiplier=entitlements.multiplier,
+                admin=entitlements.user_class == "administrator",
+                config=config,
+                stop=stop,
+            )
+        )
+        for index, (file, check) in enumerate(zip(event["files"], checks))
+    ]
+
+    # Finish and report on each file in the order it was uploaded
+    # All the files share one verdict_timeout, as in pipeline.handle_file_share
+    scan_budget = config["virustotal"].get("verdict_timeout", 900)
+    finished = 0
+    try:
+        for index, (file, task) in enumerate(zip(event["files"], tasks)):
+            finished = index + 1
+            try:
+                status, details = await task
+            except Exception:
+                logger.exception(f'Could not process {file.get("name")}')
+                status = "failed"
+                details = {"file": formatters.clean_filename(file["name"])}
+
+            if status == "downloaded":
+                # Failed or timed out scans are picked up and reported by finish_file
+                # The lookup may be shared with other uploads, so don't cancel it
+                waited = time.monotonic()
+                try:
+                    await asyncio.wait_for(
+                        asyncio.shield(asyncio.wrap_future(details["scan"])),
+                        timeout=scan_budget,
+                    )
+                except Exception:
+                    pass
+                scan_budget = max(0, scan_budget - (time.monotonic() - waited))
+                status = await asyncio.to_thread(
+                    pipeline.finish_file,
+                    details=details,
+                    index=index,
+                    folder=entitlements.folder,
+                    config=config,
+                    stop=stop,
+                    timeout=0,
+                )
+            metrics.files.inc(status=status)
+
+            # A failed notification shouldn't stop the rest of the files being handled
+            try:
+                notification_ts = await asyncio.to_thread(
+                    pipeline.report_file,
+                    status=status,
+                    details=details,
+                    file=file,
+                    event=event,
+                    app=app,
+                    config=config,
+                    entitlements=entitlements,
+                    notification_ts=notification_ts,
+                    authed_slack_users=authed_slack_users,
+                    current_members=current_members,
+                    contacts=contacts,
+                )
+            except Exception:
+                logger.exception(f'Could not report on {details["file"]}')
+    finally:
+        # If we bailed out early, don't leave the remaining files holding space
+        for task in tasks[finished:]:
+            try:
+                status, details = await task
+            except BaseException:
+                continue
+            if status == "downloaded":
+                await asyncio.to_thread(
+                    pipeline.abandon_file, details=details, folder=entitlements.folder
+                )
+
+
+def run_file_share(**kwargs) -> None:
+    # Run handle_file_share on the engine's loop from a job queue worker thread,
+    # waiting for the engine to start if it hasn't yet
+    ready.wait()
+    asyncio.run_coroutine_threadsafe(handle_file_share(**kwargs), loop).result()  # type: ignore
+
+
+def wrap(handler, app):
+    # Run a threaded Bolt listener from the async app
+    # Bolt passes listener arguments by name, so only hand over the ones the handler takes
+    wanted = inspect.signature(handler).parameters
+
+    async def async_handler(ack, body, payload, logger):
+        await ack()
+        kwargs = {
+            "ack": lambda *args, **kwargs: None,
+            "body": body,
+            "event": payload,
+            "client": app.client,
+            "logger": logger,
+        }
+        await asyncio.to_thread(
+            handler, **{key: value for key, value in kwargs.items() if key in wanted}
+        )
+
+    return async_handler
+
+
+def run(app, config: dict, events: dict, actions: dict) -> None:
+    # Serve Socket Mode from a single asyncio loop
+    # app is the threaded Bolt app, whose client is still used by the rsc modules
+    async_app = AsyncApp(token=config["slack"]["bot_token"], logger=app.logger)
+
+    for name, handler in events.items():
+        if not inspect.iscoroutinefunction(handler):
+            handler = wrap(handler=handler, app=app)
+        async_app.event(name)(handler)
+
+    for name, handler in actions.items():
+        if not inspect.iscoroutinefunction(handler):
+            handler = wrap(handler=handler, app=app)
+        async_app.action(name)(handler)
+
+    async def main():
+        global session, download_slots, loop, disk_executor
+        disk_executor = ThreadPoolExecutor(
+            max_workers=config["download"].get("async_disk_threads", 4),
+            thread_name_prefix="disk",
+        )
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=config["download"].get("async_connections", 32),
+                keepalive_timeout=60,
+            ),
+            timeout=aiohttp.ClientTimeout(total=None, sock_read=60),
+        )
+        download_slots = asyncio.Semaphore(
+            config["download"].get("async_downloads", 16)
+        )
+        loop = asyncio.get_running_loop()
+        ready.set()
+        try:
+            handler = AsyncSocketModeHandler(async_app, config["slack"]["app_token"])
+            await handler.start_async()
+        finally:
+            await session.close()
+
+    asyncio.run(main())
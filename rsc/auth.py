@@ -1,6 +1,5 @@
 import datetime
 import json
-import time
 from pprint import pprint
 from typing import Literal
 import logging
@@ -11,12 +10,16 @@ from cryptography.fernet import Fernet
 from slack_sdk.web.client import WebClient  # for typing
 from slack_sdk.web.slack_response import SlackResponse  # for typing
 
-from . import slackUtils
+from . import httpClient, sharedState, slackUtils
 
 # Set up logging
 
 logger = logging.getLogger("auth")
 
+# Recent answers from the auth server are kept in the shared state backend's
+# "auth" namespace as {"auth": auth or None}, and the shared "auth" generation
+# is bumped whenever we learn an auth has changed
+
 
 def generate_auth_request_url(
     id: str, config: dict, name: str = "", app=None, client=None
@@ -30,6 +33,9 @@ def generate_auth_request_url(
     else:
         raise ValueError("Could not get slack client")
 
+    # The user is about to authenticate, so don't trust any cached answer
+    invalidate_auth(id=id)
+
     if not name:
         # Get display name using slack ID
         name = slackUtils.get_name(id=id, client=slack)
@@ -61,7 +67,7 @@ def generate_auth_request_url(
 
 
 def get_auths(config) -> dict:
-    r = requests.get(
+    r = httpClient.get(
         f"http://{config['auth_server']['host']}:{config['auth_server']['port']}/api/v1/authList",
         headers={"Authorization": "Bearer " + config["auth_server"]["query_token"]},
     )
@@ -70,7 +76,7 @@ def get_auths(config) -> dict:
 
 def submit_auth_request(auth_request, config):
     try:
-        r = requests.post(
+        r = httpClient.post(
             f"http://{config['auth_server']['host']}:{config['auth_server']['port']}/api/v1/authRequest/{auth_request}",
         )
         if r.status_code != 200:
@@ -97,22 +103,83 @@ def submit_auth_request(auth_request, config):
     return False
 
 
+def get_auth(id, config) -> dict | None:
+    # Get the temporary auth for a single ID, if it has one
+    cached = sharedState.backend.get("auth", id)
+    if cached:
+        return cached["auth"]
+
+    r = httpClient.get(
+        f"http://{config['auth_server']['host']}:{config['auth_server']['port']}/api/v1/auth/{id}",
+        headers={"Authorization": "Bearer " + config["auth_server"]["query_token"]},
+    )
+    if r.status_code == 404:
+        # Not cached, the user may be about to authenticate
+        return None
+    elif r.status_code != 200:
+        raise requests.exceptions.HTTPError("Server returned an error")
+
+    auth = r.json()
+    cache_auth(id=id, auth=auth, config=config)
+    return auth
+
+
+def cache_auth(id, auth: dict | None, config) -> None:
+    cached = sharedState.backend.get("auth", id)
+    if cached and cached["auth"] != auth:
+        sharedState.backend.increment("auth")
+    sharedState.backend.put(
+        "auth", id, {"auth": auth}, ttl=config["auth_server"].get("cache_ttl", 30)
+    )
+
+
+def invalidate_auth(id=None) -> None:
+    # The "auth" generation invalidates everyone's cached entitlements, so only
+    # bump it when a cached auth is actually dropped
+    if not id:
+        sharedState.backend.clear("auth")
+        sharedState.backend.increment("auth")
+    elif sharedState.backend.get("auth", id):
+        sharedState.backend.delete("auth", id)
+        sharedState.backend.increment("auth")
+
+
 def check_auth(id, config) -> str | Literal[False]:
-    auths = get_auths(config)
-    if auths.get(id, None):
-        return auths[id]["name"]
+    auth = get_auth(id=id, config=config)
+    if auth:
+        return auth["name"]
     return False
 
 
+def wait_for_auth(id, config, timeout=10) -> str | Literal[False]:
+    # Block until the auth server tells us the ID has authenticated, or the timeout passes
+    try:
+        r = httpClient.get(
+            f"http://{config['auth_server']['host']}:{config['auth_server']['port']}/api/v1/authWait/{id}",
+            headers={"Authorization": "Bearer " + config["auth_server"]["query_token"]},
+            params={"timeout": timeout},
+            timeout=timeout + 5,
+        )
+    except requests.exceptions.RequestException:
+        logger.exception("Could not wait for auth")
+        return False
+    if r.status_code != 200:
+        return False
+
+    # We know about this auth before the cache would, so skip ahead
+    cache_auth(id=id, auth=r.json(), config=config)
+    return r.json()["name"]
+
+
 def check_server(config):
     # query the root endpoint
     try:
-        r = requests.get(
+        r = httpClient.get(
             url=f"http://{config['auth_server']['host']}:{config['auth_server']['port']}/"
         )
         if r.status_code != 200:
             return False
-    except requests.exceptions.ConnectionError:
+    except requests.exceptions.RequestException:
         return False
     return True
 
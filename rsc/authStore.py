@@ -0,0 +1,111 @@
+import datetime
+import heapq
+import json
+import logging
+import sqlite3
+import threading
+
+# Set up logging
+
+logger = logging.getLogger("authStore")
+
+
+class AuthStore:
+    # Temporary auths kept in SQLite, with an expiry heap so purging only touches expired entries
+
+    def __init__(self, path: str, expiry: float, legacy_file: str = ""):
+        self.expiry = expiry
+        self.lock = threading.Lock()
+        self.auths: dict[str, dict] = {}
+        self.heap: list[tuple[float, str]] = []
+        self.purged_since_vacuum = 0
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS auths (id TEXT PRIMARY KEY, name TEXT NOT NULL, from_ts REAL NOT NULL)"
+        )
+        self.db.commit()
+
+        for auth_id, name, from_ts in self.db.execute(
+            "SELECT id, name, from_ts FROM auths"
+        ):
+            self.auths[auth_id] = {"id": auth_id, "name": name, "from": from_ts}
+        self.heap = [
+            (auth["from"] + self.expiry, auth_id) for auth_id, auth in self.auths.items()
+        ]
+        heapq.heapify(self.heap)
+
+        if not self.auths and legacy_file:
+            self.import_legacy(legacy_file)
+
+        self.purge()
+
+    def import_legacy(self, legacy_file: str) -> None:
+        # Pull in auths saved by older versions as a single JSON file
+        try:
+            with open(legacy_file, "r") as f:
+                legacy: dict = json.load(f)
+        except FileNotFoundError:
+            return
+        logger.info(f"Importing {len(legacy)} auths from {legacy_file}")
+        for auth in legacy.values():
+            self.put(auth)
+
+    def put(self, auth: dict) -> None:
+        with self.lock:
+            record = {"id": auth["id"], "name": auth["name"], "from": auth["from"]}
+            self.auths[record["id"]] = record
+            heapq.heappush(self.heap, (record["from"] + self.expiry, record["id"]))
+            self.db.execute(
+                "INSERT OR REPLACE INTO auths VALUES (?, ?, ?)",
+                (record["id"], record["name"], record["from"]),
+            )
+            self.db.commit()
+
+    def get(self, auth_id: str) -> dict | None:
+        self.purge()
+        with self.lock:
+            return self.auths.get(auth_id)
+
+    def all(self) -> dict[str, dict]:
+        self.purge()
+        with self.lock:
+            return dict(self.auths)
+
+    def purge(self) -> int:
+        # Remove auths that have expired, oldest first
+        now = datetime.datetime.now().timestamp()
+        expired = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                expires, auth_id = heapq.heappop(self.heap)
+                auth = self.auths.get(auth_id)
+                # Renewed auths leave stale entries behind in the heap, skip those
+                if auth and auth["from"] + self.expiry == expires:
+                    self.auths.pop(auth_id)
+                    expired.append((auth_id,))
+
+            if expired:
+                self.db.executemany("DELETE FROM auths WHERE id = ?", expired)
+                self.db.commit()
+                self.purged_since_vacuum += len(expired)
+                logger.debug(f"Purged {len(expired)} expired auths")
+
+            self.compact()
+        return len(expired)
+
+    def compact(self) -> None:
+        # Must be called with the lock held
+        # Drop stale heap entries once they outnumber the live ones
+        if len(self.heap) > 2 * len(self.auths) + 100:
+            self.heap = [
+                (auth["from"] + self.expiry, auth_id)
+                for auth_id, auth in self.auths.items()
+            ]
+            heapq.heapify(self.heap)
+
+        # Reclaim space in the database after a lot of deletes
+        if self.purged_since_vacuum >= 1000:
+            self.db.execute("VACUUM")
+            self.purged_since_vacuum = 0
@@ -1,13 +1,146 @@
+import hashlib
+import json
 import os
+import random
+import tempfile
+import threading
+import time
 from typing import Literal
 import logging
 
-from . import formatters
+import requests
+
+from . import formatters, httpClient, metrics, sharedState
 
 # Set up logging
 
 logger = logging.getLogger("fileOperators")
 
+# In-flight downloads are written to hidden temp files inside the butler folder
+# Each resumable download also has a journal next to it recording its progress
+TEMP_PREFIX = "."
+TEMP_SUFFIX = ".part"
+JOURNAL_SUFFIX = ".part.json"
+
+# Downloads currently writing to a resumable temp file
+active_downloads: set[str] = set()
+active_downloads_lock = threading.Lock()
+
+
+# Uploads that have passed the quota check but haven't been saved yet are held
+# in the shared state backend so every bot process sees them
+folder_locks: dict[str, threading.Lock] = {}
+folder_locks_lock = threading.Lock()
+
+# Cached file listing per folder, revalidated against the directory's mtime
+usage_index: dict[str, dict] = {}
+usage_lock = threading.Lock()
+
+# With download.dedup enabled, saved files are hardlinks to a single read-only
+# blob per SHA-256. A blob's link count is its reference count, and blob_inodes
+# maps (device, inode) back to the blob so removing a link can find it.
+# Other bot processes may add blobs, so the map is reloaded when a link is missing.
+blob_inodes: dict[tuple[int, int], str] = {}
+blobs_loaded = False
+blob_lock = threading.Lock()
+
+
+class FileTooLargeError(Exception):
+    pass
+
+
+class DuplicateFileError(Exception):
+    pass
+
+
+class FolderFullError(Exception):
+    pass
+
+
+class IncompleteDownloadError(Exception):
+    pass
+
+
+def get_folder_lock(folder: str) -> threading.Lock:
+    folder = os.path.normpath(folder)
+    with folder_locks_lock:
+        if folder not in folder_locks:
+            folder_locks[folder] = threading.Lock()
+        return folder_locks[folder]
+
+
+def is_temp_file(name: str) -> bool:
+    # formatters.clean_filename strips leading dots, so saved files never match
+    return name.startswith(TEMP_PREFIX) and (
+        name.endswith(TEMP_SUFFIX) or name.endswith(JOURNAL_SUFFIX)
+    )
+
+
+def scan_folder(folder: str) -> dict:
+    # Build a usage entry for a folder from a single pass over the directory
+    # In-progress downloads are ignored
+    mtime = os.stat(folder).st_mtime_ns
+    files = {}
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if is_temp_file(entry.name):
+                continue
+            stat = entry.stat()
+            files[entry.name] = (stat.st_size, stat.st_ctime)
+    return {
+        "mtime": mtime,
+        "files": files,
+        "size": sum(size for size, ctime in files.values()),
+    }
+
+
+def get_usage(folder: str) -> dict:
+    # Get the cached usage entry for a folder, rescanning only if the directory has changed
+    # Callers must hold usage_lock while reading the returned entry
+    folder = os.path.normpath(folder)
+    mtime = os.stat(folder).st_mtime_ns
+    usage = usage_index.get(folder)
+    if not usage or usage["mtime"] != mtime:
+        logger.debug(f"Rescanning {folder}")
+        usage = scan_folder(folder)
+        usage_index[folder] = usage
+    return usage
+
+
+def track_change(folder: str, name: str, operation):
+    # Run a filesystem operation on a file in a folder and update the usage index to match
+    # The index is only carried forward if it was current before the operation,
+    # otherwise it is left stale and rebuilt on the next read
+    folder = os.path.normpath(folder)
+    with usage_lock:
+        before = os.stat(folder).st_mtime_ns
+        result = operation()
+        after = os.stat(folder).st_mtime_ns
+
+        usage = usage_index.get(folder)
+        if not usage or usage["mtime"] != before:
+            return result
+        usage["mtime"] = after
+
+        if is_temp_file(name):
+            return result
+
+        old_size, old_ctime = usage["files"].pop(name, (0, 0))
+        usage["size"] -= old_size
+        try:
+            stat = os.stat(f"{folder}/{name}")
+        except FileNotFoundError:
+            return result
+        usage["files"][name] = (stat.st_size, stat.st_ctime)
+        usage["size"] += stat.st_size
+    return result
+
+
+def list_folder(folder) -> list[str]:
+    # List the files in a folder, ignoring downloads that are still in progress
+    with usage_lock:
+        return list(get_usage(folder)["files"])
+
 
 def check_folder_eligibility(
     contacts,
@@ -35,17 +168,60 @@ def check_folder_eligibility(
 
     folder = f'{config["download"]["root_directory"]}/{folder_name}/{config["download"]["folder_name"]}/'
 
+    return folder_has_space(folder=folder, config=config, multiplier=multiplier)
+
+
+def folder_has_space(
+    folder: str, config: dict, multiplier=1, pending_files=0, pending_size=0
+) -> bool:
+    with usage_lock:
+        usage = get_usage(folder)
+        file_count = len(usage["files"])
+        folder_size = usage["size"]
+
     # Check if the folder has reached the maximum number of files
-    if len(os.listdir(folder)) >= config["download"]["max_folder_files"] * multiplier:
+    if file_count + pending_files >= config["download"]["max_folder_files"] * multiplier:
         return False
 
     # Check if the folder size is over the maximum size
-    folder_size = get_current_folder_size(folder)
-    if folder_size >= config["download"]["max_folder_size"] * multiplier:
+    if folder_size + pending_size >= config["download"]["max_folder_size"] * multiplier:
         return False
     return True
 
 
+def reserve_file(folder: str, filename: str, size: int, config: dict, multiplier=1):
+    # Atomically check a file against the folder's quota and hold its place
+    # so concurrent uploads can't overshoot the limits between check and save
+    def admit(pending: dict[str, int]) -> None:
+        if sharedState.backend.shared:
+            # Another process may have changed the folder within the directory's
+            # mtime resolution, so don't trust our cached listing for the quota
+            with usage_lock:
+                usage_index.pop(os.path.normpath(folder), None)
+
+        if filename in pending or os.path.exists(f"{folder}/{filename}"):
+            raise DuplicateFileError(filename)
+
+        if not folder_has_space(
+            folder=folder,
+            config=config,
+            multiplier=multiplier,
+            pending_files=len(pending),
+            pending_size=sum(pending.values()),
+        ):
+            raise FolderFullError(folder)
+
+    with get_folder_lock(folder):
+        sharedState.backend.reserve(
+            folder=os.path.normpath(folder), filename=filename, size=size, admit=admit
+        )
+
+
+def release_file(folder: str, filename: str) -> None:
+    with get_folder_lock(folder):
+        sharedState.backend.release(folder=os.path.normpath(folder), filename=filename)
+
+
 def get_current_files(
     folder=None, user: str = "", config={}, contacts=None, authed_slack_users=None
 ):
@@ -58,22 +234,15 @@ def get_current_files(
             "Must provide either folder or user, config, contacts and authed_slack_users"
         )
 
-    files = []
-    for file in os.listdir(directory):
-        # get the size of each file
-        size = os.path.getsize(f"{directory}/{file}")
-
-        # get the creation time of each file
-        ctime = os.path.getctime(f"{directory}/{file}")
+    with usage_lock:
+        usage = get_usage(directory)
+        return [(file, size, ctime) for file, (size, ctime) in usage["files"].items()]
 
-        files.append((file, size, ctime))
-    return files
 
-
-def delete_folder_contents(folder):
+def delete_folder_contents(folder, config=None):
     try:
-        for file in os.listdir(folder):
-            os.remove(f"{folder}/{file}")
+        for file in list_folder(folder):
+            remove_file(path=f"{folder}/{file}", config=config)
     except:
         return False
     return True
@@ -91,7 +260,424 @@ def get_current_folder_size(
             "Must provide either folder or user, config, contacts and authed_slack_users"
         )
 
-    folder_size = 0
-    for file in os.listdir(directory):
-        folder_size += os.path.getsize(f"{directory}/{file}")
-    return folder_size
+    with usage_lock:
+        return get_usage(directory)["size"]
+
+
+def create_temp_file(folder: str) -> tuple[int, str]:
+    # Returns an open file descriptor and path for a new hidden temp file in the folder
+    return track_change(
+        folder=folder,
+        name=TEMP_PREFIX + TEMP_SUFFIX,
+        operation=lambda: tempfile.mkstemp(
+            dir=folder, prefix=TEMP_PREFIX, suffix=TEMP_SUFFIX
+        ),
+    )
+
+
+def journal_path(temp_path: str) -> str:
+    return temp_path[: -len(TEMP_SUFFIX)] + JOURNAL_SUFFIX
+
+
+def read_journal(temp_path: str) -> dict | None:
+    try:
+        with open(journal_path(temp_path)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_journal(temp_path: str, journal: dict) -> None:
+    path = journal_path(temp_path)
+
+    def write():
+        with open(path, "w") as f:
+            json.dump(journal, f)
+
+    folder, name = os.path.split(path)
+    track_change(folder=folder, name=name, operation=write)
+
+
+def remove_journal(temp_path: str) -> None:
+    path = journal_path(temp_path)
+    folder, name = os.path.split(path)
+    try:
+        track_change(folder=folder, name=name, operation=lambda: os.remove(path))
+    except FileNotFoundError:
+        pass
+
+
+def verify_part(temp_path: str, journal: dict) -> dict:
+    # Re-read a partial download, keeping only the blocks that match the journal
+    # Anything after the first mismatch is truncated and downloaded again
+    file_hash = hashlib.sha256()
+    received = 0
+    verified = []
+    with open(temp_path, "r+b") as f:
+        for size, block_hash in journal["blocks"]:
+            block = f.read(size)
+            if len(block) != size or hashlib.sha256(block).hexdigest() != block_hash:
+                break
+            file_hash.update(block)
+            received += size
+            verified.append([size, block_hash])
+        f.truncate(received)
+
+    if len(verified) < len(journal["blocks"]):
+        logger.warning(f"Discarding unverified data after {received} bytes in {temp_path}")
+    journal["blocks"] = verified
+    return {"received": received, "hash": file_hash}
+
+
+def purge_stale_parts(folder: str, max_age: float) -> None:
+    # Remove partial downloads that were never resumed, along with their journals
+    cutoff = time.time() - max_age
+    stale = set()
+    with os.scandir(os.path.normpath(folder)) as entries:
+        for entry in entries:
+            if not is_temp_file(entry.name) or entry.stat().st_mtime >= cutoff:
+                continue
+            if entry.name.endswith(JOURNAL_SUFFIX):
+                stale.add(entry.path[: -len(JOURNAL_SUFFIX)] + TEMP_SUFFIX)
+            else:
+                stale.add(entry.path)
+
+    with active_downloads_lock:
+        stale -= active_downloads
+    for path in stale:
+        logger.debug(f"Removing stale partial download {path}")
+        discard_temp_file(path)
+
+
+def fetch_range(
+    url: str, temp_path: str, journal: dict, state: dict, config: dict, max_size: int
+) -> None:
+    # Download from wherever the temp file left off to the end of the file
+    # state holds the bytes received and the running hash, and is kept up to
+    # date as chunks are written so a failed attempt can be picked up again
+    block_size = config["download"].get("resume_block", 8388608)
+    headers = {"Authorization": f'Bearer {config["slack"]["bot_token"]}'}
+    if state["received"]:
+        headers["Range"] = f'bytes={state["received"]}-'
+        # Only resume if the file hasn't changed since we started
+        if journal.get("validator"):
+            headers["If-Range"] = journal["validator"]
+
+    block_hash = hashlib.sha256()
+    block_length = 0
+    with open(temp_path, "r+b") as f, httpClient.get(
+        url, headers=headers, stream=True
+    ) as r:
+        try:
+            if r.status_code == 416 and state["received"] == journal.get("size"):
+                # We already had the whole file
+                return
+            r.raise_for_status()
+
+            if state["received"] and r.status_code != 206:
+                # The server sent the whole file rather than the rest of it
+                logger.debug(f"Server ignored range request, restarting {temp_path}")
+                state["received"] = 0
+                state["hash"] = hashlib.sha256()
+                journal["blocks"] = []
+                f.truncate(0)
+
+            journal["validator"] = r.headers.get("ETag") or r.headers.get(
+                "Last-Modified"
+            )
+            if "Content-Length" in r.headers:
+                journal["size"] = state["received"] + int(r.headers["Content-Length"])
+            f.seek(state["received"])
+
+            for chunk in r.iter_content(
+                chunk_size=config["download"].get("chunk_size", 1048576)
+            ):
+                # Slack's reported size can't be trusted, so enforce the limit here too
+                if state["received"] + len(chunk) > max_size:
+                    raise FileTooLargeError(f"Download exceeded {max_size} bytes: {url}")
+                f.write(chunk)
+                state["hash"].update(chunk)
+                state["received"] += len(chunk)
+                block_hash.update(chunk)
+                block_length += len(chunk)
+
+                if block_length >= block_size:
+                    f.flush()
+                    journal["blocks"].append([block_length, block_hash.hexdigest()])
+                    write_journal(temp_path=temp_path, journal=journal)
+                    block_hash = hashlib.sha256()
+                    block_length = 0
+
+            if journal.get("size") and state["received"] < journal["size"]:
+                raise IncompleteDownloadError(
+                    f'Got {state["received"]} of {journal["size"]} bytes: {url}'
+                )
+        finally:
+            # Record the partial block too so a retry doesn't have to fetch it again
+            if block_length:
+                f.flush()
+                journal["blocks"].append([block_length, block_hash.hexdigest()])
+                write_journal(temp_path=temp_path, journal=journal)
+
+
+def is_transient(e: Exception) -> bool:
+    if isinstance(e, requests.exceptions.HTTPError):
+        return e.response is not None and e.response.status_code >= 500
+    return isinstance(
+        e,
+        (
+            IncompleteDownloadError,
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+        ),
+    )
+
+
+def download_file(url: str, folder: str, config: dict, max_size: int) -> tuple[str, str]:
+    # Stream a file from Slack into a temp file in the butler folder, hashing as we go
+    # Dropped connections are retried with backoff from where they left off, and
+    # downloads that still fail are discarded, since nothing retries the same URL
+    # A download cut off by the bot stopping is resumed when its job is recovered
+    # Returns the path of the temp file and its SHA-256 hash
+    key = hashlib.sha256(url.encode()).hexdigest()[:32]
+    temp_path = f"{os.path.normpath(folder)}/{TEMP_PREFIX}{key}{TEMP_SUFFIX}"
+
+    with active_downloads_lock:
+        resumable = temp_path not in active_downloads
+        if resumable:
+            active_downloads.add(temp_path)
+    if not resumable:
+        # The same file is already being fetched into this folder
+        fd, temp_path = create_temp_file(folder=folder)
+        os.close(fd)
+
+    try:
+        journal = read_journal(temp_path) if resumable else None
+        if journal and journal.get("url") == url and os.path.exists(temp_path):
+            state = verify_part(temp_path=temp_path, journal=journal)
+            logger.info(f'Resuming {temp_path} from {state["received"]} bytes')
+        else:
+            purge_stale_parts(
+                folder=folder, max_age=config["download"].get("part_ttl", 86400)
+            )
+            track_change(
+                folder=folder,
+                name=os.path.basename(temp_path),
+                operation=lambda: open(temp_path, "wb").close(),
+            )
+            journal = {"url": url, "validator": None, "size": None, "blocks": []}
+            state = {"received": 0, "hash": hashlib.sha256()}
+
+        attempt = 0
+        while True:
+            try:
+                fetch_range(
+                    url=url,
+                    temp_path=temp_path,
+                    journal=journal,
+                    state=state,
+                    config=config,
+                    max_size=max_size,
+                )
+                break
+            except Exception as e:
+                attempt += 1
+                if not is_transient(e) or attempt > config["download"].get("retries", 5):
+                    discard_temp_file(temp_path)
+                    raise
+                wait = min(
+                    config["download"].get("max_backoff", 60), 2**attempt
+                ) * random.uniform(0.5, 1.5)
+                logger.warning(
+                    f'Download interrupted at {state["received"]} bytes ({e}), retrying in {wait:.0f}s'
+                )
+                time.sleep(wait)
+    finally:
+        with active_downloads_lock:
+            active_downloads.discard(temp_path)
+
+    remove_journal(temp_path)
+    metrics.transfer_bytes.observe(state["received"], direction="download")
+    logger.debug(f'Downloaded {state["received"]} bytes to {temp_path}')
+    return temp_path, state["hash"].hexdigest()
+
+
+def dedup_enabled(config: dict | None) -> bool:
+    return bool(config and config["download"].get("dedup", False))
+
+
+def blob_directory(config: dict) -> str:
+    return config["download"]["blob_directory"]
+
+
+def validate_dedup(config: dict) -> None:
+    # Blobs hold every member's uploads, so they mustn't be anywhere the file
+    # server shares. They also need to be on the same filesystem as the butler
+    # folders so files can be hardlinked.
+    directory = config["download"].get("blob_directory")
+    if not directory:
+        raise Exception("download.blob_directory must be set to enable dedup")
+
+    root = os.path.realpath(config["download"]["root_directory"])
+    directory = os.path.realpath(directory)
+    if os.path.commonpath([root, directory]) == root:
+        raise Exception(
+            f"download.blob_directory ({directory}) must be outside the root directory ({root})"
+        )
+
+    os.makedirs(directory, exist_ok=True)
+    if os.stat(directory).st_dev != os.stat(root).st_dev:
+        logger.warning(
+            f"{directory} is on a different filesystem to {root}, files won't be deduplicated"
+        )
+
+
+def blob_path(file_hash: str, config: dict) -> str:
+    return f"{blob_directory(config)}/{file_hash[:2]}/{file_hash}"
+
+
+def load_blobs(config: dict) -> None:
+    # Must be called with blob_lock held
+    global blobs_loaded
+    if blobs_loaded:
+        return
+
+    directory = blob_directory(config)
+    os.makedirs(directory, exist_ok=True)
+    blob_inodes.clear()
+    for prefix in os.scandir(directory):
+        if not prefix.is_dir():
+            continue
+        for entry in os.scandir(prefix.path):
+            stat = entry.stat()
+            blob_inodes[(stat.st_dev, stat.st_ino)] = entry.path
+    blobs_loaded = True
+    logger.debug(f"Loaded {len(blob_inodes)} blobs from {directory}")
+
+
+def find_blob(stat: os.stat_result, config: dict) -> str | None:
+    # Must be called with blob_lock held
+    # Returns the blob a saved file is linked to, if any
+    global blobs_loaded
+    load_blobs(config)
+    if (stat.st_dev, stat.st_ino) not in blob_inodes:
+        # The blob may have been created by another bot process
+        blobs_loaded = False
+        load_blobs(config)
+    return blob_inodes.get((stat.st_dev, stat.st_ino))
+
+
+def collect_blobs(config: dict) -> int:
+    # Remove blobs that are no longer linked from any folder, eg. because the
+    # files were deleted through the file server rather than by us
+    if not dedup_enabled(config):
+        return 0
+    validate_dedup(config)
+
+    removed = 0
+    with blob_lock:
+        load_blobs(config)
+        for key, path in list(blob_inodes.items()):
+            try:
+                if os.stat(path).st_nlink > 1:
+                    continue
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            del blob_inodes[key]
+            removed += 1
+
+    if removed:
+        logger.info(f"Removed {removed} unreferenced blobs")
+    return removed
+
+
+def link_blob(temp_path: str, path: str, file_hash: str, config: dict) -> bool:
+    # Save a download as a link to the blob for its hash, creating the blob if
+    # this is the first copy. Returns False if the file couldn't be linked.
+    folder, name = os.path.split(path)
+    blob = blob_path(file_hash=file_hash, config=config)
+
+    with blob_lock:
+        load_blobs(config)
+        try:
+            if os.path.exists(blob):
+                # We already have this file, so the download can be thrown away
+                track_change(
+                    folder=folder, name=name, operation=lambda: os.link(blob, path)
+                )
+                discard_temp_file(temp_path)
+                logger.debug(f"Linked {path} to existing blob {file_hash}")
+                return True
+
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            os.link(temp_path, blob)
+        except OSError as e:
+            # Different filesystems, link limit reached, or links not supported
+            logger.warning(f"Could not link {path} to blob {file_hash}: {e}")
+            return False
+
+        # Blobs are shared between folders, so editing one copy in place
+        # would change all of them
+        os.chmod(blob, 0o444)
+        stat = os.stat(blob)
+        blob_inodes[(stat.st_dev, stat.st_ino)] = blob
+
+        track_change(
+            folder=folder, name=name, operation=lambda: os.replace(temp_path, path)
+        )
+    return True
+
+
+def commit_temp_file(
+    temp_path: str, path: str, file_hash: str = "", config: dict | None = None
+) -> None:
+    # Atomically move a completed download into place
+    if file_hash and dedup_enabled(config):
+        if link_blob(temp_path=temp_path, path=path, file_hash=file_hash, config=config):  # type: ignore
+            return
+
+    folder, name = os.path.split(path)
+    track_change(
+        folder=folder, name=name, operation=lambda: os.replace(temp_path, path)
+    )
+
+
+def remove_file(path: str, config: dict | None = None) -> None:
+    # Delete a saved file, and its blob if this was the last link to it
+    folder, name = os.path.split(path)
+    if not dedup_enabled(config):
+        track_change(folder=folder, name=name, operation=lambda: os.remove(path))
+        return
+
+    with blob_lock:
+        stat = os.stat(path)
+        track_change(folder=folder, name=name, operation=lambda: os.remove(path))
+        if stat.st_nlink < 2:
+            return
+
+        blob = find_blob(stat=stat, config=config)  # type: ignore
+        if not blob:
+            return
+        # Check the blob now rather than trusting the count from before, as other
+        # processes may have linked or removed copies in the meantime
+        # The blob itself holds one link
+        try:
+            blob_stat = os.stat(blob)
+            if blob_stat.st_ino != stat.st_ino or blob_stat.st_nlink > 1:
+                return
+            os.remove(blob)
+        except FileNotFoundError:
+            pass
+        del blob_inodes[(stat.st_dev, stat.st_ino)]
+        logger.debug(f"Removed blob {os.path.basename(blob)}")
+
+
+def discard_temp_file(temp_path: str) -> None:
+    folder, name = os.path.split(temp_path)
+    try:
+        track_change(folder=folder, name=name, operation=lambda: os.remove(temp_path))
+    except FileNotFoundError:
+        pass
+    remove_journal(temp_path)
@@ -7,7 +7,7 @@ from typing import Any, Literal
 
 import requests
 
-from . import auth, blocks, fileOperators, slackUtils, strings, util
+from . import auth, blocks, fileOperators, slackUtils, strings, util, validators
 
 # Set up logging
 
@@ -53,6 +53,8 @@ def clean_filename(filename: str) -> str:
     # Remove any characters that aren't allowed in a filename
     filename = filename.replace("..", ".")
     filename = "".join(x for x in filename if x.isalnum() or x in " .-_")
+    # Names starting with a dot are reserved for in-progress downloads
+    filename = filename.lstrip(".")
     return filename
 
 
@@ -77,7 +79,7 @@ def home(
     )
 
     # If the folder field is blank the user is not entitled to use this service
-    if not entitlements["folder"]:
+    if not entitlements.folder:
         block_list = copy(blocks.not_authed)
         block_list[-1]["text"]["text"] = block_list[-1]["text"]["text"].replace(
             "{signup_url}", config["tidyhq"]["signup_url"]
@@ -92,17 +94,17 @@ def home(
             block_list += blocks.request_auth_step_2
         return block_list
 
-    if not os.path.exists(entitlements["folder"]):
-        os.makedirs(entitlements["folder"])
+    if not os.path.exists(entitlements.folder):
+        os.makedirs(entitlements.folder)
 
     folder_size = fileOperators.get_current_folder_size(
-        folder=entitlements["folder"],
+        folder=entitlements.folder,
     )
     folder_items = fileOperators.get_current_files(
-        folder=entitlements["folder"],
+        folder=entitlements.folder,
     )
 
-    if entitlements["user_class"][0] in ["a", "e", "i", "o", "u"]:
+    if entitlements.user_class[0] in ["a", "e", "i", "o", "u"]:
         user_class_prefix = "an"
     else:
         user_class_prefix = "a"
@@ -114,28 +116,27 @@ def home(
     block_list += copy(blocks.quota)
     block_list[-2]["text"]["text"] = strings.quota.format(
         user_class_prefix=user_class_prefix,
-        user_class=entitlements["user_class"],
+        user_class=entitlements.user_class,
         max_file_size=file_size(
-            1000000000
-            if config["download"]["max_file_size"] * entitlements["multiplier"]
-            > 1000000000
-            else config["download"]["max_file_size"] * entitlements["multiplier"]
+            validators.max_file_size(
+                config=config, multiplier=entitlements.multiplier
+            )
         ),
         current_folder_size=file_size(folder_size),
         max_folder_size=file_size(
-            config["download"]["max_folder_size"] * entitlements["multiplier"]
+            config["download"]["max_folder_size"] * entitlements.multiplier
         ),
         folder_size_bar=create_progress_bar(
             current=folder_size,
-            total=config["download"]["max_folder_size"] * entitlements["multiplier"],
+            total=config["download"]["max_folder_size"] * entitlements.multiplier,
             segments=7,
         ),
         current_folder_items=len(folder_items),
         max_folder_files=config["download"]["max_folder_files"]
-        * entitlements["multiplier"],
+        * entitlements.multiplier,
         folder_items_bar=create_progress_bar(
             current=len(folder_items),
-            total=config["download"]["max_folder_files"] * entitlements["multiplier"],
+            total=config["download"]["max_folder_files"] * entitlements.multiplier,
             segments=7,
         ),
     )
@@ -164,7 +165,7 @@ def home(
 
     block_list += copy(blocks.folder_location)
     block_list[-1]["text"]["text"] = blocks.folder_location[-1]["text"]["text"].format(
-        folder=entitlements["folder"]
+        folder=entitlements.folder
     )
 
     block_list += blocks.current_file_delete
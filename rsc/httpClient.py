@@ -0,0 +1,101 @@
+import logging
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from . import metrics
+
+# Set up logging
+
+logger = logging.getLogger("httpClient")
+
+# (connect, read) timeout used when the caller doesn't give one
+DEFAULT_TIMEOUT = (5, 60)
+
+# Settings from the "http" section of config.json, see configure()
+settings: dict = {}
+
+# One session per host so each gets its own keep-alive connection pool
+sessions: dict[str, requests.Session] = {}
+sessions_lock = threading.Lock()
+
+# Per-host request counts, error counts and cumulative latency
+stats: dict[str, dict[str, float]] = {}
+stats_lock = threading.Lock()
+
+
+def configure(config: dict) -> None:
+    settings.update(config.get("http", {}))
+
+
+def get_session(host: str) -> requests.Session:
+    with sessions_lock:
+        if host not in sessions:
+            retry = Retry(
+                total=settings.get("retries", 2),
+                backoff_factor=settings.get("backoff_factor", 0.3),
+                status_forcelist=[502, 503, 504],
+                allowed_methods=["GET", "HEAD"],
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=settings.get("pool_size", 10),
+                max_retries=retry,
+            )
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            sessions[host] = session
+        return sessions[host]
+
+
+def record(host: str, method: str, elapsed: float, error: bool) -> None:
+    metrics.outbound_seconds.observe(elapsed, service=host, operation=method)
+    if error:
+        metrics.outbound_errors.inc(service=host, operation=method)
+
+    with stats_lock:
+        host_stats = stats.setdefault(
+            host, {"requests": 0, "errors": 0, "total_seconds": 0.0}
+        )
+        host_stats["requests"] += 1
+        host_stats["total_seconds"] += elapsed
+        if error:
+            host_stats["errors"] += 1
+
+
+def request(method: str, url: str, **kwargs) -> requests.Response:
+    # Drop-in for requests.request that reuses pooled connections and always has a timeout
+    host = urlparse(url).netloc
+    timeout = settings.get("timeout", DEFAULT_TIMEOUT)
+    kwargs.setdefault("timeout", tuple(timeout) if isinstance(timeout, list) else timeout)
+
+    start = time.monotonic()
+    error = False
+    try:
+        r = get_session(host).request(method, url, **kwargs)
+        error = r.status_code >= 500
+        return r
+    except requests.exceptions.RequestException:
+        error = True
+        raise
+    finally:
+        record(host=host, method=method, elapsed=time.monotonic() - start, error=error)
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request("GET", url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return request("POST", url, **kwargs)
+
+
+def get_stats() -> dict[str, dict[str, float]]:
+    with stats_lock:
+        return {host: dict(host_stats) for host, host_stats in stats.items()}
@@ -0,0 +1,48 @@
+import collections
+import threading
+import time
+
+from . import metrics
+
+
+class RecentSet:
+    # Bounded set of recently seen keys, oldest first
+    # Keys are forgotten after `ttl` seconds or once there are more than `max_size`
+
+    def __init__(self, name: str, max_size: int = 10000, ttl: float = 3600):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.seen: collections.OrderedDict = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def expire(self, now: float) -> None:
+        # Must be called with the lock held
+        while self.seen and (
+            len(self.seen) > self.max_size or next(iter(self.seen.values())) < now
+        ):
+            self.seen.popitem(last=False)
+
+    def add(self, key) -> bool:
+        # Remember a key, returning False if it was already seen
+        now = time.monotonic()
+        with self.lock:
+            self.expire(now)
+            if key in self.seen:
+                metrics.duplicates.inc(kind=self.name)
+                return False
+            self.seen[key] = now + self.ttl
+        return True
+
+
+def new_files(event: dict, recent_files: RecentSet) -> list[dict]:
+    # The files in a file_share event that haven't been seen recently
+    # Files are keyed by the message that shared them, so only redeliveries are
+    # dropped and sharing the same file again later still works
+    # Files without an ID can't be deduplicated so are always kept
+    return [
+        file
+        for file in event.get("files", [])
+        if "id" not in file
+        or recent_files.add((event["user"], file["id"], event.get("ts")))
+    ]
@@ -0,0 +1,241 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from . import metrics, sharedState
+
+# Set up logging
+
+logger = logging.getLogger("jobQueue")
+
+# file_share events waiting to be processed, kept in SQLite so they survive restarts
+db: sqlite3.Connection | None = None
+db_lock = threading.Lock()
+
+# Signalled whenever a job is added
+jobs_available = threading.Condition(db_lock)
+workers: list[threading.Thread] = []
+
+
+def open_db(config: dict) -> None:
+    global db
+    path = config.get("jobs", {}).get("db_file", "upload_jobs.db")
+    with db_lock:
+        db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                event TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            )"""
+        )
+        # Which process is running each job, so others know whether it's still alive
+        if "owner" not in [row[1] for row in db.execute("PRAGMA table_info(jobs)")]:
+            db.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+        db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+        # Every file we've queued, so redelivered events aren't processed twice
+        # Files are keyed by the message that shared them so sharing the same file
+        # again later is still processed
+        if "ts" not in [row[1] for row in db.execute("PRAGMA table_info(files)")]:
+            db.execute("DROP TABLE IF EXISTS files")
+        db.execute(
+            """CREATE TABLE IF NOT EXISTS files (
+                user TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                ts TEXT NOT NULL,
+                job_id INTEGER NOT NULL,
+                created REAL NOT NULL,
+                PRIMARY KEY (user, file_id, ts)
+            )"""
+        )
+
+        # Anything that was running in a process that has since stopped gets picked up again
+        recovered = 0
+        for job_id, owner in db.execute(
+            "SELECT id, owner FROM jobs WHERE status = 'running'"
+        ).fetchall():
+            if not owner_alive(owner):
+                db.execute("UPDATE jobs SET status = 'pending' WHERE id = ?", (job_id,))
+                recovered += 1
+        db.commit()
+    if recovered:
+        logger.info(f"Recovered {recovered} interrupted upload jobs")
+
+
+def owner_alive(owner: str | None) -> bool:
+    # Owners are "host:pid", see sharedState.owner
+    if not owner:
+        return False
+    host, _, pid = owner.rpartition(":")
+    if host != socket.gethostname():
+        # We can't tell, so assume it's still working on it
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def purge(config: dict) -> None:
+    # Forget files and failed jobs older than the retention period
+    cutoff = time.time() - config.get("jobs", {}).get("retention", 604800)
+    with db_lock:
+        db.execute("DELETE FROM files WHERE created < ?", (cutoff,))  # type: ignore
+        db.execute(  # type: ignore
+            "DELETE FROM jobs WHERE status = 'failed' AND updated < ?", (cutoff,)
+        )
+        db.commit()  # type: ignore
+
+
+def enqueue(event: dict) -> bool:
+    # Queue a file_share event for the workers
+    # Files that have already been queued for this user are dropped from the event,
+    # and False is returned if that leaves nothing to do
+    now = time.time()
+    with jobs_available:
+        try:
+            job_id = db.execute(  # type: ignore
+                "INSERT INTO jobs (event, created, updated) VALUES ('', ?, ?)",
+                (now, now),
+            ).lastrowid
+
+            new_files = []
+            for file in event["files"]:
+                if "id" in file:
+                    inserted = db.execute(  # type: ignore
+                        "INSERT OR IGNORE INTO files (user, file_id, ts, job_id, created) VALUES (?, ?, ?, ?, ?)",
+                        (event["user"], file["id"], event.get("ts", ""), job_id, now),
+                    ).rowcount
+                    if not inserted:
+                        continue
+                new_files.append(file)
+
+            if not new_files:
+                db.rollback()  # type: ignore
+                return False
+
+            db.execute(  # type: ignore
+                "UPDATE jobs SET event = ? WHERE id = ?",
+                (json.dumps({**event, "files": new_files}), job_id),
+            )
+            db.commit()  # type: ignore
+        except Exception:
+            # Don't leave a half-written job for the next commit to save
+            db.rollback()  # type: ignore
+            raise
+
+        pending = db.execute(  # type: ignore
+            "SELECT COUNT(*) FROM jobs WHERE status = 'pending'"
+        ).fetchone()[0]
+        jobs_available.notify()
+
+    metrics.queue_depth.observe(pending - 1, queue="jobs")
+    return True
+
+
+def claim() -> tuple[int, str, int, float] | None:
+    # Must be called with db_lock held
+    # Other bot processes may share the queue, so take the write lock before looking
+    db.execute("BEGIN IMMEDIATE")  # type: ignore
+    try:
+        row = db.execute(  # type: ignore
+            "SELECT id, event, attempts, created FROM jobs WHERE status = 'pending' ORDER BY id LIMIT 1"
+        ).fetchone()
+        if not row:
+            db.rollback()  # type: ignore
+            return None
+        db.execute(  # type: ignore
+            "UPDATE jobs SET status = 'running', owner = ?, attempts = attempts + 1, updated = ? WHERE id = ?",
+            (sharedState.owner, time.time(), row[0]),
+        )
+        db.commit()  # type: ignore
+    except Exception:
+        db.rollback()  # type: ignore
+        raise
+    return row[0], row[1], row[2] + 1, row[3]
+
+
+def finish(job_id: int, status: str) -> None:
+    with jobs_available:
+        try:
+            if status == "done":
+                db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))  # type: ignore
+            else:
+                db.execute(  # type: ignore
+                    "UPDATE jobs SET status = ?, updated = ? WHERE id = ?",
+                    (status, time.time(), job_id),
+                )
+            db.commit()  # type: ignore
+        except Exception:
+            db.rollback()  # type: ignore
+            raise
+        if status == "pending":
+            jobs_available.notify()
+
+
+def run_worker(handler, config: dict) -> None:
+    max_attempts = config.get("jobs", {}).get("max_attempts", 3)
+    # Jobs queued by other processes don't wake us, so check every so often anyway
+    poll_interval = config.get("jobs", {}).get("poll_interval", 5)
+    while True:
+        # Errors such as the database being locked by another process shouldn't
+        # stop the worker, so wait a bit and try again
+        try:
+            with jobs_available:
+                job = claim()
+                while not job:
+                    jobs_available.wait(timeout=poll_interval)
+                    job = claim()
+        except Exception:
+            logger.exception("Could not claim an upload job")
+            time.sleep(poll_interval)
+            continue
+        job_id, event, attempts, created = job
+
+        if attempts == 1:
+            metrics.stage_seconds.observe(time.time() - created, stage="queued")
+
+        try:
+            handler(json.loads(event))
+            status = "done"
+        except Exception:
+            logger.exception(f"Upload job {job_id} failed on attempt {attempts}")
+            if attempts < max_attempts:
+                status = "pending"
+            else:
+                logger.error(f"Giving up on upload job {job_id}")
+                status = "failed"
+
+        try:
+            finish(job_id=job_id, status=status)
+        except Exception:
+            # The job stays running until this process restarts and recovers it
+            logger.exception(f"Could not mark upload job {job_id} as {status}")
+
+
+def start(config: dict, handler) -> None:
+    # Open the queue and start processing jobs, including any left over from last time
+    # handler is called with each event and should raise if it needs retrying
+    open_db(config=config)
+    purge(config=config)
+
+    for i in range(config.get("jobs", {}).get("workers", 2)):
+        thread = threading.Thread(
+            target=run_worker,
+            kwargs={"handler": handler, "config": config},
+            name=f"upload-worker-{i}",
+            daemon=True,
+        )
+        thread.start()
+        workers.append(thread)
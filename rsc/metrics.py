@@ -0,0 +1,198 @@
+import bisect
+import logging
+import threading
+import time
+
+# Set up logging
+
+logger = logging.getLogger("metrics")
+
+# Bucket upper bounds for each kind of histogram
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+BYTES_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9)
+DEPTH_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250)
+
+# Every metric by name, in the order they were created
+registry: dict = {}
+
+
+def label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(key: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{escape(value)}"' for name, value in key]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.values: dict[tuple, float] = {}
+        self.lock = threading.Lock()
+        registry[name] = self
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in self.values.items():
+                lines.append(f"{self.name}{format_labels(key)} {value}")
+        return lines
+
+
+class Timer:
+    # Context manager that observes the time spent inside it
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram: "Histogram", labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self) -> "Timer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, buckets: tuple):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        # Each series holds a count per bucket, one for +Inf, then the sum
+        self.values: dict[tuple, list] = {}
+        self.lock = threading.Lock()
+        registry[name] = self
+
+    def observe(self, value: float, **labels) -> None:
+        key = label_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = [0] * (len(self.buckets) + 1) + [0.0]
+                self.values[key] = series
+            series[index] += 1
+            series[-1] += value
+
+    def time(self, **labels) -> Timer:
+        return Timer(histogram=self, labels=labels)
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self.lock:
+            snapshot = {key: list(series) for key, series in self.values.items()}
+
+        for key, series in snapshot.items():
+            # Buckets are stored individually but reported cumulatively
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                total += count
+                le = format_labels(key, extra=f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {total}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {series[-1]}")
+            lines.append(f"{self.name}_count{format_labels(key)} {total}")
+        return lines
+
+
+stage_seconds = Histogram(
+    "filebutler_stage_seconds",
+    "Time spent in each stage of handling an upload",
+    LATENCY_BUCKETS,
+)
+outbound_seconds = Histogram(
+    "filebutler_outbound_seconds",
+    "Latency of requests to Slack, TidyHQ, VirusTotal and the auth server",
+    LATENCY_BUCKETS,
+)
+outbound_errors = Counter(
+    "filebutler_outbound_errors_total",
+    "Outbound requests that failed or returned a server error",
+)
+transfer_bytes = Histogram(
+    "filebutler_transfer_bytes",
+    "Size of each file transferred",
+    BYTES_BUCKETS,
+)
+queue_depth = Histogram(
+    "filebutler_queue_depth",
+    "Items already waiting in a queue when another is added",
+    DEPTH_BUCKETS,
+)
+files = Counter("filebutler_files_total", "Uploaded files by outcome")
+duplicates = Counter(
+    "filebutler_duplicates_total", "Redelivered events and files that were skipped"
+)
+
+
+def render() -> str:
+    lines = []
+    for metric in list(registry.values()):
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def wsgi_app(environ, start_response):
+    if environ.get("PATH_INFO") != "/metrics":
+        start_response("404 Not Found", [("Content-Type", "text/plain")])
+        return [b"Not found\n"]
+
+    body = render().encode()
+    start_response(
+        "200 OK",
+        [
+            ("Content-Type", "text/plain; version=0.0.4"),
+            ("Content-Length", str(len(body))),
+        ],
+    )
+    return [body]
+
+
+def start_server(config: dict) -> None:
+    # Serve /metrics from a background thread if a port is configured
+    # When running several bot processes each takes the first free port from
+    # metrics.port onwards, trying up to metrics.max_processes ports
+    metrics_config = config.get("metrics", {})
+    if not metrics_config.get("port"):
+        logger.debug("No metrics port configured, not serving metrics")
+        return
+
+    from waitress import create_server
+
+    for port in range(
+        metrics_config["port"],
+        metrics_config["port"] + metrics_config.get("max_processes", 1),
+    ):
+        try:
+            server = create_server(
+                wsgi_app,
+                host=metrics_config.get("host", "localhost"),
+                port=port,
+                threads=1,
+            )
+            break
+        except OSError as e:
+            logger.debug(f"Could not serve metrics on port {port}: {e}")
+    else:
+        logger.error("No free port to serve metrics on, not serving metrics")
+        return
+
+    threading.Thread(target=server.run, name="metrics", daemon=True).start()
+    logger.info(f"Serving metrics on port {port}")
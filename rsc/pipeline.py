@@ -0,0 +1,562 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from . import (
+    adminFeed,
+    fileOperators,
+    formatters,
+    metrics,
+    slackUtils,
+    strings,
+    util,
+    validators,
+    virustotal,
+)
+
+# Set up logging
+
+logger = logging.getLogger("pipeline")
+
+# Shared across events so the total number of concurrent downloads stays bounded
+executor: ThreadPoolExecutor | None = None
+executor_lock = threading.Lock()
+
+# Files submitted to the executor that haven't started yet
+waiting = 0
+waiting_lock = threading.Lock()
+
+
+def get_executor(config: dict) -> ThreadPoolExecutor:
+    global executor
+    with executor_lock:
+        if not executor:
+            executor = ThreadPoolExecutor(
+                max_workers=config["download"].get("workers", 4),
+                thread_name_prefix="file-worker",
+            )
+        return executor
+
+
+class StopMarker:
+    # Tracks the earliest file in an event that halted processing.
+    # Files after it are discarded instead of saved, matching sequential behaviour.
+    def __init__(self, count: int):
+        self.index = count
+        self.lock = threading.Lock()
+
+    def stop(self, index: int) -> None:
+        with self.lock:
+            self.index = min(self.index, index)
+
+    def stopped(self, index: int) -> bool:
+        with self.lock:
+            return index > self.index
+
+
+def check_file(
+    file: dict, index: int, folder: str, multiplier, config: dict, stop: StopMarker
+) -> tuple[str, dict]:
+    # Check whether a file can be saved, reserving space for it in the folder if so
+    # Returns "ok" if the file should be downloaded, otherwise the reason it shouldn't
+    filename = formatters.clean_filename(file["name"])
+    details = {"file": filename}
+
+    if stop.stopped(index):
+        return "cancelled", details
+
+    # Check if the file is too large
+    if not validators.check_size(
+        file_object=file, config=config, multiplier=multiplier
+    ):
+        return "too_big", details
+
+    # Check for duplicates and hold a place in the folder quota
+    try:
+        fileOperators.reserve_file(
+            folder=folder,
+            filename=filename,
+            size=file["size"],
+            config=config,
+            multiplier=multiplier,
+        )
+    except fileOperators.DuplicateFileError:
+        return "duplicate", details
+    except fileOperators.FolderFullError:
+        # Since the folder is full we can stop processing files
+        stop.stop(index)
+        return "folder_full", details
+
+    return "ok", details
+
+
+def check_files(
+    files: list[dict], folder: str, multiplier, config: dict, stop: StopMarker
+) -> list[tuple[str, dict]]:
+    # Check every file in the order it was uploaded, so the earliest files get
+    # the space left in the folder whatever order the downloads finish in
+    checks: list[tuple[str, dict]] = []
+    try:
+        for index, file in enumerate(files):
+            with metrics.stage_seconds.time(stage="quota"):
+                checks.append(
+                    check_file(
+                        file=file,
+                        index=index,
+                        folder=folder,
+                        multiplier=multiplier,
+                        config=config,
+                        stop=stop,
+                    )
+                )
+    except Exception:
+        # Give back the space we'd already reserved
+        for status, details in checks:
+            if status == "ok":
+                fileOperators.release_file(folder=folder, filename=details["file"])
+        raise
+    return checks
+
+
+def process_file(
+    file: dict,
+    details: dict,
+    index: int,
+    folder: str,
+    multiplier,
+    admin: bool,
+    config: dict,
+    stop: StopMarker,
+) -> tuple[str, dict]:
+    # Download a single file that has passed check_file and queue it for a virus check
+    # Returns a status and the details needed to finish or report on it
+    global waiting
+    with waiting_lock:
+        waiting -= 1
+
+    filename = details["file"]
+    if stop.stopped(index):
+        fileOperators.release_file(folder=folder, filename=filename)
+        return "cancelled", details
+
+    # Stream the file to a temp file in the butler folder
+    try:
+        with metrics.stage_seconds.time(stage="download"):
+            temp_path, file_hash = fileOperators.download_file(
+                url=file["url_private"],
+                folder=folder,
+                config=config,
+                max_size=validators.max_file_size(config=config, multiplier=multiplier),
+            )
+    except fileOperators.FileTooLargeError:
+        fileOperators.release_file(folder=folder, filename=filename)
+        return "too_big", details
+    except Exception:
+        logger.exception(f"Could not download {filename}")
+        fileOperators.release_file(folder=folder, filename=filename)
+        return "failed", details
+
+    # The file waits on disk until VirusTotal gets back to us
+    details["temp_path"] = temp_path
+    details["hash"] = file_hash
+    try:
+        details["scan"] = virustotal.submit(
+            file_hash=file_hash, config=config, size=file["size"], admin=admin
+        )
+    except Exception:
+        logger.exception(f"Could not queue {filename} for a virus check")
+        abandon_file(details=details, folder=folder)
+        return "scan_failed", details
+    return "downloaded", details
+
+
+def abandon_file(details: dict, folder: str) -> None:
+    # Give back everything held for a downloaded file that won't be saved
+    fileOperators.discard_temp_file(details["temp_path"])
+    fileOperators.release_file(folder=folder, filename=details["file"])
+
+
+def finish_file(
+    details: dict,
+    index: int,
+    folder: str,
+    config: dict,
+    stop: StopMarker,
+    timeout: float | None = None,
+) -> str:
+    # Save or discard a downloaded file once its virus check is done
+    # Gives up on the virus check after timeout seconds, verdict_timeout by default
+    filename = details["file"]
+    if timeout is None:
+        timeout = config["virustotal"].get("verdict_timeout", 900)
+    try:
+        if stop.stopped(index):
+            fileOperators.discard_temp_file(details["temp_path"])
+            return "cancelled"
+
+        try:
+            with metrics.stage_seconds.time(stage="scan"):
+                virus_check = virustotal.virus_name(
+                    details["scan"].result(timeout=timeout)
+                )
+        except Exception:
+            logger.exception(f"Could not get a verdict for {filename}")
+            fileOperators.discard_temp_file(details["temp_path"])
+            return "scan_failed"
+
+        if virus_check:
+            fileOperators.discard_temp_file(details["temp_path"])
+            # If one of the files is a virus stop processing files
+            stop.stop(index)
+            details["virus_name"] = virus_check
+            return "virus"
+
+        # Move the file into place now that it has a clean verdict
+        try:
+            with metrics.stage_seconds.time(stage="write"):
+                fileOperators.commit_temp_file(
+                    temp_path=details["temp_path"],
+                    path=f"{folder}/{filename}",
+                    file_hash=details["hash"],
+                    config=config,
+                )
+        except Exception:
+            logger.exception(f"Could not save {filename}")
+            fileOperators.discard_temp_file(details["temp_path"])
+            return "failed"
+        return "saved"
+
+    finally:
+        fileOperators.release_file(folder=folder, filename=filename)
+
+
+def prepare_upload(
+    event: dict,
+    app,
+    config: dict,
+    authed_slack_users,
+    current_members,
+    contacts,
+) -> util.Entitlements | None:
+    # Work out where a user's files go, making sure the folder exists
+    # Returns None if the user isn't allowed to upload files
+    user: str = event["user"]
+
+    entitlements = util.check_entitlements(
+        user=user,
+        config=config,
+        authed_slack_users_local=authed_slack_users,
+        current_members_local=current_members,
+        contacts=contacts,
+        app=app,
+    )
+
+    # Users with no entitlements are given info on how to get them
+    if not entitlements.folder:
+        slackUtils.send(
+            app=app,
+            event=event,
+            message=strings.not_authed.format(signup_url=config["tidyhq"]["signup_url"])
+            + strings.not_authed_msg_addon,
+        )
+        # Let the notification channel know
+        slackUtils.send(
+            app=app,
+            event=event,
+            message=strings.not_authed_admin.format(user=user),
+            channel=config["slack"]["notification_channel"],
+        )
+        return None
+
+    # Check if the butler folder exists
+    if not os.path.exists(entitlements.folder):
+        slackUtils.send(
+            app=app,
+            event=event,
+            message=strings.no_butler_directory.format(
+                folder=config["download"]["folder_name"]
+            ),
+        )
+
+    # Create the folder if it doesn't exist
+    if not os.path.exists(entitlements.folder):
+        os.makedirs(entitlements.folder)
+
+    return entitlements
+
+
+def report_file(
+    status: str,
+    details: dict,
+    file: dict,
+    event: dict,
+    app,
+    config: dict,
+    entitlements: util.Entitlements,
+    notification_ts,
+    authed_slack_users,
+    current_members,
+    contacts,
+):
+    # Let the user and the notification channel know what happened to a file
+    # Returns the ts of the notification channel thread for this upload
+    user: str = event["user"]
+    filename = details["file"]
+
+    if status == "cancelled":
+        return notification_ts
+
+    elif status == "failed":
+        slackUtils.send(
+            app=app,
+            event=event,
+            message=strings.upload_failed.format(file=filename),
+        )
+
+    elif status == "scan_failed":
+        slackUtils.send(
+            app=app,
+            event=event,
+            message=strings.scan_failed.format(file=filename),
+        )
+
+    elif status == "duplicate":
+        slackUtils.send(
+            app=app,
+            event=event,
+            message=strings.duplicate_file.format(
+                folder=entitlements.folder, file=filename
+            ),
+        )
+
+    elif status == "too_big":
+        slackUtils.send(
+            app=app,
+            event=event,
+            message=strings.file_too_big.format(
+                file=filename,
+                size=formatters.file_size(file["size"]),
+                max_file_size=formatters.file_size(
+                    num=validators.max_file_size(
+                        config=config, multiplier=entitlements.multiplier
+                    )
+                ),
+            ),
+        )
+
+    elif status == "folder_full":
+        slackUtils.send(
+            app=app,
+            event=event,
+            message=strings.over_folder_limit.format(
+                file=filename,
+                max_folder_size=formatters.file_size(
+                    config["download"]["max_folder_size"]
+                    * entitlements.multiplier
+                ),
+                max_folder_files=config["download"]["max_folder_files"]
+                * entitlements.multiplier,
+                butler_folder=config["download"]["folder_name"],
+            ),
+        )
+
+        # Let the notification channel know
+        ts = slackUtils.send(
+            app=app,
+            event=event,
+            message=strings.over_folder_limit_admin.format(
+                file=filename,
+                max_folder_size=formatters.file_size(
+                    config["download"]["max_folder_size"]
+                    * entitlements.multiplier
+                ),
+                max_folder_files=config["download"]["max_folder_files"]
+                * entitlements.multiplier,
+                butler_folder=config["download"]["folder_name"],
+                user=user,
+            ),
+            channel=config["slack"]["notification_channel"],
+            ts=notification_ts,
+            broadcast=True,
+        )
+
+        if not notification_ts:
+            notification_ts = ts
+
+    elif status == "virus":
+        # Explicitly warn the notification channel
+        ts = slackUtils.send(
+            app=app,
+            event=event,
+            message=strings.virus_found_admin.format(
+                user=user, file=filename, virus_name=details["virus_name"]
+            ),
+            channel=config["slack"]["notification_channel"],
+            ts=notification_ts,
+            broadcast=True,
+        )
+
+        if not notification_ts:
+            notification_ts = ts
+
+        # Let the user know there was a problem
+        slackUtils.send(
+            app=app,
+            event=event,
+            message=strings.virus_found,
+        )
+
+    elif status == "saved":
+        # Let the user know the file was saved
+        slackUtils.send(
+            app=app,
+            event=event,
+            message=strings.file_saved.format(
+                file=filename, folder=entitlements.folder
+            ),
+        )
+
+        # Let the notification channel know, batched with the rest of this burst
+        adminFeed.notify(
+            user=user,
+            line=strings.file_saved_admin.format(
+                file=filename, folder=entitlements.folder, user=user
+            ),
+            app=app,
+            config=config,
+        )
+
+        # Update the app home once the burst of saves is over
+        slackUtils.schedule_home_update(
+            user=user,
+            client=app.client,
+            config=config,
+            authed_slack_users=authed_slack_users,
+            contacts=contacts,
+            current_members=current_members,
+        )
+
+    return notification_ts
+
+
+def handle_file_share(
+    event: dict,
+    app,
+    config: dict,
+    authed_slack_users,
+    current_members,
+    contacts,
+) -> None:
+    with metrics.stage_seconds.time(stage="entitlements"):
+        entitlements = prepare_upload(
+            event=event,
+            app=app,
+            config=config,
+            authed_slack_users=authed_slack_users,
+            current_members=current_members,
+            contacts=contacts,
+        )
+    if not entitlements:
+        return
+
+    notification_ts = None
+
+    # Reserve space in upload order, then download and scan in parallel
+    stop = StopMarker(count=len(event["files"]))
+    checks = check_files(
+        files=event["files"],
+        folder=entitlements.folder,
+        multiplier=entitlements.multiplier,
+        config=config,
+        stop=stop,
+    )
+
+    global waiting
+    with waiting_lock:
+        metrics.queue_depth.observe(waiting, queue="downloads")
+        waiting += sum(status == "ok" for status, _ in checks)
+
+    futures: list[Future | None] = []
+    finished = 0
+    try:
+        for index, (file, (status, details)) in enumerate(zip(event["files"], checks)):
+            futures.append(
+                get_executor(config).submit(
+                    process_file,
+                    file=file,
+                    details=details,
+                    index=index,
+                    folder=entitlements.folder,
+                    multiplier=entitlements.multiplier,
+                    admin=entitlements.user_class == "administrator",
+                    config=config,
+                    stop=stop,
+                )
+                if status == "ok"
+                else None
+            )
+
+        # Finish and report on each file in the order it was uploaded
+        # All the files share one verdict_timeout, so a backlog of lookups can't
+        # hold up the job queue for long
+        scan_budget = config["virustotal"].get("verdict_timeout", 900)
+        for index, (file, future) in enumerate(zip(event["files"], futures)):
+            finished = index + 1
+            try:
+                status, details = future.result() if future else checks[index]
+            except Exception:
+                logger.exception(f'Could not process {file.get("name")}')
+                status = "failed"
+                details = {"file": formatters.clean_filename(file["name"])}
+
+            if status == "downloaded":
+                waited = time.monotonic()
+                status = finish_file(
+                    details=details,
+                    index=index,
+                    folder=entitlements.folder,
+                    config=config,
+                    stop=stop,
+                    timeout=scan_budget,
+                )
+                scan_budget = max(0, scan_budget - (time.monotonic() - waited))
+            metrics.files.inc(status=status)
+
+            # A failed notification shouldn't stop the rest of the files being handled
+            try:
+                with metrics.stage_seconds.time(stage="notify"):
+                    notification_ts = report_file(
+                        status=status,
+                        details=details,
+                        file=file,
+                        event=event,
+                        app=app,
+                        config=config,
+                        entitlements=entitlements,
+                        notification_ts=notification_ts,
+                        authed_slack_users=authed_slack_users,
+                        current_members=current_members,
+                        contacts=contacts,
+                    )
+            except Exception:
+                logger.exception(f'Could not report on {details["file"]}')
+    finally:
+        # If we bailed out early, don't leave the remaining files holding space
+        for index in range(finished, len(checks)):
+            status, details = checks[index]
+            if status != "ok":
+                continue
+            if index >= len(futures):
+                # Never submitted
+                fileOperators.release_file(
+                    folder=entitlements.folder, filename=details["file"]
+                )
+                continue
+            try:
+                status, details = futures[index].result()  # type: ignore
+            except Exception:
+                continue
+            if status == "downloaded":
+                abandon_file(details=details, folder=entitlements.folder)
@@ -0,0 +1,75 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+# Set up logging
+
+logger = logging.getLogger("rateLimit")
+
+
+class TokenBucket:
+    # Allows up to `capacity` calls in a burst, refilling at `rate` calls per second
+    # Callers waiting on acquire() are served lowest priority number first
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.held_until = 0.0
+        self.lock = threading.Condition()
+        self.waiters: list[tuple[int, int]] = []
+        self.tickets = itertools.count()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self) -> float:
+        # Must be called with the lock held
+        # Returns 0 if a token was taken, otherwise how long until one is available
+        now = time.monotonic()
+        if now < self.held_until:
+            return self.held_until - now
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def try_acquire(self) -> float:
+        # Take a token if one is available and nobody is queued ahead of us
+        # Returns 0 on success, otherwise how long to wait before trying again
+        with self.lock:
+            if self.waiters:
+                return 1 / self.rate
+            return self.take()
+
+    def acquire(self, priority: int = 0) -> None:
+        with self.lock:
+            ticket = (priority, next(self.tickets))
+            heapq.heappush(self.waiters, ticket)
+            try:
+                while True:
+                    if self.waiters[0] == ticket:
+                        wait = self.take()
+                        if not wait:
+                            return
+                    else:
+                        wait = None
+                    self.lock.wait(wait)
+            finally:
+                self.waiters.remove(ticket)
+                heapq.heapify(self.waiters)
+                self.lock.notify_all()
+
+    def hold(self, seconds: float) -> None:
+        # Stop handing out tokens for a while, eg. when the remote end reports we're over quota
+        with self.lock:
+            now = time.monotonic()
+            self.held_until = max(self.held_until, now + seconds)
+            self.tokens = 0
+            self.updated = max(self.updated, self.held_until)
+            self.lock.notify_all()
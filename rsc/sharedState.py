@@ -0,0 +1,258 @@
+import contextlib
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from typing import Any, Callable
+
+# Set up logging
+
+logger = logging.getLogger("sharedState")
+
+# Identifies this process when it holds a lease or a quota reservation
+owner = f"{socket.gethostname()}:{os.getpid()}"
+
+# State that has to agree between bot processes lives behind one of these backends:
+#   get/put/delete/clear  - JSON-compatible values by namespace and key, optionally expiring
+#   counters/increment    - generation numbers used to invalidate caches
+#   acquire_lease         - lets one process at a time do a job such as syncing TidyHQ
+#   reserve/release       - atomic check-and-hold of a place in a folder's quota
+# Backends with shared = False only hold state for the current process.
+
+
+class LocalBackend:
+    # Everything kept in memory, for running a single bot process
+    shared = False
+
+    def __init__(self, config: dict | None = None):
+        self.lock = threading.Lock()
+        self.values: dict[tuple[str, str], tuple[float | None, Any]] = {}
+        self.counts: dict[str, int] = {}
+        self.leases: dict[str, tuple[str, float]] = {}
+        self.reservations: dict[str, dict[str, int]] = {}
+
+    def get(self, namespace: str, key: str) -> Any:
+        with self.lock:
+            entry = self.values.get((namespace, key))
+        if not entry or (entry[0] and entry[0] < time.time()):
+            return None
+        return entry[1]
+
+    def put(self, namespace: str, key: str, value: Any, ttl: float | None = None) -> None:
+        with self.lock:
+            self.values[(namespace, key)] = (time.time() + ttl if ttl else None, value)
+
+    def delete(self, namespace: str, key: str) -> None:
+        with self.lock:
+            self.values.pop((namespace, key), None)
+
+    def clear(self, namespace: str) -> None:
+        with self.lock:
+            for key in [key for key in self.values if key[0] == namespace]:
+                del self.values[key]
+
+    def counters(self, *names: str) -> tuple[int, ...]:
+        with self.lock:
+            return tuple(self.counts.get(name, 0) for name in names)
+
+    def increment(self, name: str) -> int:
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+            return self.counts[name]
+
+    def acquire_lease(self, name: str, ttl: float) -> bool:
+        return True
+
+    def reserve(
+        self, folder: str, filename: str, size: int, admit: Callable[[dict], None]
+    ) -> None:
+        # admit is given the folder's pending reservations and raises to refuse
+        # Callers hold the folder's lock, so nothing else reserves in between
+        with self.lock:
+            pending = dict(self.reservations.get(folder, {}))
+        admit(pending)
+        with self.lock:
+            self.reservations.setdefault(folder, {})[filename] = size
+
+    def release(self, folder: str, filename: str) -> None:
+        with self.lock:
+            self.reservations.get(folder, {}).pop(filename, None)
+
+
+class SQLiteBackend:
+    # State shared through a SQLite database in WAL mode, for several bot
+    # processes on the same host
+    shared = True
+
+    def __init__(self, config: dict):
+        settings = config.get("shared_state", {})
+        # Reservations are held while a file downloads and waits for its virus
+        # check, so by default allow an hour to download on top of verdict_timeout
+        verdict_timeout = config.get("virustotal", {}).get("verdict_timeout", 900)
+        self.reservation_ttl = settings.get("reservation_ttl", verdict_timeout + 3600)
+        if self.reservation_ttl <= verdict_timeout:
+            logger.warning(
+                "shared_state.reservation_ttl is shorter than virustotal.verdict_timeout, uploads may overshoot folder quotas"
+            )
+        self.lock = threading.Lock()
+        self.writes = 0
+
+        # Transactions are managed explicitly so they can take the write lock up front
+        self.db = sqlite3.connect(
+            settings.get("path", "shared_state.db"),
+            check_same_thread=False,
+            timeout=30,
+            isolation_level=None,
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS kv (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                expires REAL,
+                PRIMARY KEY (namespace, key)
+            )"""
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)"
+        )
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS reservations (
+                folder TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                owner TEXT NOT NULL,
+                expires REAL NOT NULL,
+                PRIMARY KEY (folder, filename)
+            )"""
+        )
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # Takes the database write lock, so only one process is inside at a time
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def get(self, namespace: str, key: str) -> Any:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value FROM kv WHERE namespace = ? AND key = ? AND (expires IS NULL OR expires > ?)",
+                (namespace, key, time.time()),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, namespace: str, key: str, value: Any, ttl: float | None = None) -> None:
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO kv (namespace, key, value, expires) VALUES (?, ?, ?, ?)",
+                (namespace, key, json.dumps(value), now + ttl if ttl else None),
+            )
+            # Clear out expired values every so often
+            self.writes += 1
+            if self.writes % 1000 == 0:
+                self.db.execute("DELETE FROM kv WHERE expires < ?", (now,))
+
+    def delete(self, namespace: str, key: str) -> None:
+        with self.lock:
+            self.db.execute(
+                "DELETE FROM kv WHERE namespace = ? AND key = ?", (namespace, key)
+            )
+
+    def clear(self, namespace: str) -> None:
+        with self.lock:
+            self.db.execute("DELETE FROM kv WHERE namespace = ?", (namespace,))
+
+    def counters(self, *names: str) -> tuple[int, ...]:
+        with self.lock:
+            rows = dict(
+                self.db.execute(
+                    f'SELECT name, value FROM counters WHERE name IN ({",".join("?" * len(names))})',
+                    names,
+                ).fetchall()
+            )
+        return tuple(rows.get(name, 0) for name in names)
+
+    def increment(self, name: str) -> int:
+        with self.transaction() as db:
+            db.execute(
+                "INSERT INTO counters (name, value) VALUES (?, 1) ON CONFLICT (name) DO UPDATE SET value = value + 1",
+                (name,),
+            )
+            return db.execute(
+                "SELECT value FROM counters WHERE name = ?", (name,)
+            ).fetchone()[0]
+
+    def acquire_lease(self, name: str, ttl: float) -> bool:
+        # Take or renew a lease, returning False if another live process holds it
+        now = time.time()
+        with self.transaction() as db:
+            row = db.execute(
+                "SELECT owner, expires FROM leases WHERE name = ?", (name,)
+            ).fetchone()
+            if row and row[0] != owner and row[1] > now:
+                return False
+            db.execute(
+                "INSERT OR REPLACE INTO leases (name, owner, expires) VALUES (?, ?, ?)",
+                (name, owner, now + ttl),
+            )
+        return True
+
+    def reserve(
+        self, folder: str, filename: str, size: int, admit: Callable[[dict], None]
+    ) -> None:
+        # Reservations left behind by a process that died expire after reservation_ttl
+        now = time.time()
+        with self.transaction() as db:
+            pending = dict(
+                db.execute(
+                    "SELECT filename, size FROM reservations WHERE folder = ? AND expires > ?",
+                    (folder, now),
+                ).fetchall()
+            )
+            admit(pending)
+            db.execute(
+                "INSERT OR REPLACE INTO reservations (folder, filename, size, owner, expires) VALUES (?, ?, ?, ?, ?)",
+                (folder, filename, size, owner, now + self.reservation_ttl),
+            )
+
+    def release(self, folder: str, filename: str) -> None:
+        with self.lock:
+            self.db.execute(
+                "DELETE FROM reservations WHERE folder = ? AND filename = ?",
+                (folder, filename),
+            )
+
+
+# Available backends by the name used for shared_state.backend in config.json
+backends: dict[str, type] = {
+    "local": LocalBackend,
+    "sqlite": SQLiteBackend,
+}
+
+backend: Any = LocalBackend()
+
+
+def configure(config: dict) -> None:
+    global backend, owner
+    # Worked out again in case we were forked after import
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    name = config.get("shared_state", {}).get("backend", "local")
+    if name not in backends:
+        raise Exception(f"Unknown shared state backend: {name}")
+    backend = backends[name](config)
+    logger.info(f"Using {name} shared state backend")
@@ -0,0 +1,108 @@
+import contextlib
+import contextvars
+import logging
+import threading
+import time
+
+from slack_sdk.errors import SlackApiError
+from slack_sdk.web.client import WebClient
+
+from . import metrics, rateLimit
+
+# Set up logging
+
+logger = logging.getLogger("slackClient")
+
+# Calls per minute allowed in each tier (https://api.slack.com/apis/rate-limits)
+TIER_LIMITS = {1: 1, 2: 20, 3: 50, 4: 100}
+
+# Tiers of the methods we use, anything else is assumed to be tier 3
+METHOD_TIERS = {
+    "auth.test": 4,
+    "bots.info": 3,
+    "chat.update": 3,
+    "conversations.open": 3,
+    "usergroups.list": 2,
+    "users.info": 4,
+    "views.publish": 4,
+}
+
+# chat.postMessage is limited to roughly one message a second per channel
+PER_CHANNEL_LIMIT = 60
+
+# Lower numbers are sent first when calls are queued
+USER = 0
+ADMIN = 1
+
+current_priority: contextvars.ContextVar[int] = contextvars.ContextVar(
+    "slack_priority", default=USER
+)
+
+
+@contextlib.contextmanager
+def priority(level: int):
+    # Calls made inside this block are queued at the given priority
+    token = current_priority.set(level)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+class RateLimitedWebClient(WebClient):
+    # WebClient that queues calls into a token bucket per method so we stay
+    # inside Slack's tier limits, and waits out Retry-After when we don't
+
+    def __init__(self, *args, rate_limits: dict | None = None, max_retries=3, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rate_limits = rate_limits or {}
+        self.max_retries = max_retries
+        self.buckets: dict[str, rateLimit.TokenBucket] = {}
+        self.buckets_lock = threading.Lock()
+
+    def get_bucket(self, api_method: str, kwargs: dict) -> rateLimit.TokenBucket:
+        key = api_method
+        if api_method in self.rate_limits:
+            per_minute = self.rate_limits[api_method]
+        elif api_method == "chat.postMessage":
+            # Each channel gets its own bucket
+            body = kwargs.get("json") or kwargs.get("data") or kwargs.get("params") or {}
+            key = f'{api_method}:{body.get("channel", "")}'
+            per_minute = PER_CHANNEL_LIMIT
+        else:
+            per_minute = TIER_LIMITS[METHOD_TIERS.get(api_method, 3)]
+
+        with self.buckets_lock:
+            if key not in self.buckets:
+                # Allow short bursts of up to ten seconds' worth of calls
+                self.buckets[key] = rateLimit.TokenBucket(
+                    rate=per_minute / 60, capacity=max(1, per_minute / 6)
+                )
+            return self.buckets[key]
+
+    def api_call(self, api_method: str, *args, **kwargs):  # type: ignore
+        bucket = self.get_bucket(api_method, kwargs)
+        attempt = 0
+        while True:
+            metrics.queue_depth.observe(len(bucket.waiters), queue=f"slack:{api_method}")
+            bucket.acquire(priority=current_priority.get())
+            start = time.perf_counter()
+            try:
+                return super().api_call(api_method, *args, **kwargs)
+            except SlackApiError as e:
+                metrics.outbound_errors.inc(service="slack", operation=api_method)
+                if e.response.status_code != 429 or attempt >= self.max_retries:
+                    raise
+                headers = e.response.headers or {}
+                retry_after = float(
+                    headers.get("Retry-After", headers.get("retry-after", 1))
+                )
+                logger.warning(
+                    f"Rate limited on {api_method}, waiting {retry_after:.0f}s"
+                )
+                bucket.hold(retry_after)
+                attempt += 1
+            finally:
+                metrics.outbound_seconds.observe(
+                    time.perf_counter() - start, service="slack", operation=api_method
+                )
@@ -1,14 +1,79 @@
+import hashlib
+import json
 import logging
+import os
+import threading
+import time
 from typing import Any
 
+from slack_sdk.errors import SlackApiError
 from slack_sdk.web.client import WebClient  # for typing
 
-from . import formatters
+from . import formatters, metrics, sharedState, slackClient
 
 # Set up logging
 
 logger = logging.getLogger("formatters")
 
+# Members of the unlimited usergroups, refreshed every slack.unlimited_ttl seconds,
+# and the shared "unlimited" generation they match
+unlimited_users: set[str] = set()
+unlimited_expires: float = 0
+unlimited_generation = 0
+unlimited_lock = threading.Lock()
+
+# DM channel for each user, persisted so we only ever open each DM once
+# With a shared state backend they're stored there instead of in the file
+dm_channel_file = "dm_channels.json"
+dm_channels: dict[str, str] | None = None
+dm_lock = threading.Lock()
+
+# Home updates waiting to be rendered, mapping user to the latest request for them
+pending_homes: dict[str, dict[str, Any]] = {}
+home_lock = threading.Lock()
+
+
+def load_dm_channels(path: str = "") -> None:
+    global dm_channels, dm_channel_file
+    if path:
+        dm_channel_file = path
+    try:
+        with open(dm_channel_file, "r") as f:
+            dm_channels = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        dm_channels = {}
+    logger.debug(f"Loaded {len(dm_channels)} DM channels")  # type: ignore
+
+
+def get_dm_channel(user: str, app, refresh=False) -> str:
+    with dm_lock:
+        if dm_channels is None:
+            load_dm_channels()
+        if not refresh and user in dm_channels:  # type: ignore
+            return dm_channels[user]  # type: ignore
+
+    # Another process may have opened it already
+    if not refresh and sharedState.backend.shared:
+        channel = sharedState.backend.get("dm_channels", user)
+        if channel:
+            with dm_lock:
+                dm_channels[user] = channel  # type: ignore
+            return channel
+
+    # Open a DM with the user
+    response = app.client.conversations_open(users=user)
+    channel = response.data["channel"]["id"]
+
+    if sharedState.backend.shared:
+        sharedState.backend.put("dm_channels", user, channel)
+    with dm_lock:
+        dm_channels[user] = channel  # type: ignore
+        if not sharedState.backend.shared:
+            with open(f"{dm_channel_file}.tmp", "w") as f:
+                json.dump(dm_channels, f)
+            os.replace(f"{dm_channel_file}.tmp", dm_channel_file)
+    return channel
+
 
 def send(
     event, message: "str", app=None, channel=None, ts=None, broadcast=False, dm=False
@@ -31,18 +96,27 @@ def send(
         event["channel"] = channel
 
     if (not event.get("ts", False) and not channel) or dm:
-        # Open a DM with the user
-        response = app.client.conversations_open(users=user)
-        channel = response.data["channel"]["id"]
+        channel = get_dm_channel(user=user, app=app)
 
         # Send an unthreaded message to the user
-        response = app.client.chat_postMessage(
-            channel=channel, text=message, reply_broadcast=broadcast
-        )
+        try:
+            response = app.client.chat_postMessage(
+                channel=channel, text=message, reply_broadcast=broadcast
+            )
+        except SlackApiError as e:
+            if e.response["error"] != "channel_not_found":
+                raise
+            # Our saved channel has gone stale, open a fresh one
+            channel = get_dm_channel(user=user, app=app, refresh=True)
+            response = app.client.chat_postMessage(
+                channel=channel, text=message, reply_broadcast=broadcast
+            )
 
     elif channel:
         # Send an unthreaded message to the channel
-        response = app.client.chat_postMessage(channel=channel, text=message)
+        # These are admin notifications, so user replies go ahead of them
+        with slackClient.priority(slackClient.ADMIN):
+            response = app.client.chat_postMessage(channel=channel, text=message)
 
     else:
         # Send a threaded message to the user
@@ -56,7 +130,8 @@ def send(
     return response.data["ts"]
 
 
-def check_unlimited(user, config, app=None, client=None):
+def refresh_unlimited(config, app=None, client=None) -> set[str]:
+    global unlimited_users, unlimited_expires, unlimited_generation
     if app:
         r = app.client.usergroups_list(include_users=True)
     elif client:
@@ -65,11 +140,82 @@ def check_unlimited(user, config, app=None, client=None):
         raise Exception("Must provide either app or client")
 
     groups: list[dict[str, Any]] = r.data["usergroups"]
+    users = set()
     for group in groups:
         if group["id"] in config["slack"]["unlimited_groups"]:
-            if user in group["users"]:
-                return True
-    return False
+            users.update(group.get("users", []))
+
+    ttl = config["slack"].get("unlimited_ttl", 300)
+    if sharedState.backend.shared:
+        sharedState.backend.put("slack", "unlimited_users", sorted(users), ttl=ttl)
+    if users != unlimited_users:
+        sharedState.backend.increment("unlimited")
+
+    # Swap in the new set in one go so readers never see a partial update
+    unlimited_generation = sharedState.backend.counters("unlimited")[0]
+    unlimited_users = users
+    unlimited_expires = time.monotonic() + ttl
+    logger.debug(f"Found {len(users)} users in unlimited groups")
+    return users
+
+
+def load_unlimited(config) -> bool:
+    # Use the members another process fetched, if they haven't expired
+    global unlimited_users, unlimited_expires, unlimited_generation
+    generation = sharedState.backend.counters("unlimited")[0]
+    users = sharedState.backend.get("slack", "unlimited_users")
+    if users is None:
+        return False
+    unlimited_generation = generation
+    unlimited_users = set(users)
+    unlimited_expires = time.monotonic() + config["slack"].get("unlimited_ttl", 300)
+    return True
+
+
+def invalidate_unlimited() -> None:
+    global unlimited_expires
+    unlimited_expires = 0
+    sharedState.backend.delete("slack", "unlimited_users")
+    sharedState.backend.increment("unlimited")
+
+
+def check_unlimited(user, config, app=None, client=None):
+    global unlimited_expires
+    if (
+        sharedState.backend.shared
+        and sharedState.backend.counters("unlimited")[0] != unlimited_generation
+    ):
+        # Another process has seen the groups change
+        unlimited_expires = 0
+
+    if time.monotonic() >= unlimited_expires:
+        # Only one thread needs to refresh an expired cache
+        with unlimited_lock:
+            if time.monotonic() >= unlimited_expires:
+                if not (sharedState.backend.shared and load_unlimited(config=config)):
+                    refresh_unlimited(config=config, app=app, client=client)
+    return user in unlimited_users
+
+
+def start_unlimited_refresh(config, app=None, client=None) -> threading.Thread:
+    # Keep the unlimited group cache warm so check_unlimited never has to wait on Slack
+    def refresh_loop():
+        # Background refreshes shouldn't hold up user-facing calls
+        slackClient.current_priority.set(slackClient.ADMIN)
+        ttl = config["slack"].get("unlimited_ttl", 300)
+        while True:
+            # Only one process needs to ask Slack, the others load what it found
+            try:
+                if sharedState.backend.acquire_lease("unlimited-refresh", ttl=ttl):
+                    with unlimited_lock:
+                        refresh_unlimited(config=config, app=app, client=client)
+            except Exception:
+                logger.exception("Could not refresh unlimited group members")
+            time.sleep(ttl / 2)
+
+    thread = threading.Thread(target=refresh_loop, name="unlimited-refresh", daemon=True)
+    thread.start()
+    return thread
 
 
 def update_home(
@@ -81,19 +227,69 @@ def update_home(
     current_members,
     auth_step=None,
 ) -> None:
-    home_view = {
-        "type": "home",
-        "blocks": formatters.home(
-            user=user,
-            config=config,
-            authed_slack_users=authed_slack_users,
-            contacts=contacts,
-            client=client,
-            current_members=current_members,
-            auth_step=auth_step,
-        ),
-    }
+    with metrics.stage_seconds.time(stage="home_render"):
+        home_view = {
+            "type": "home",
+            "blocks": formatters.home(
+                user=user,
+                config=config,
+                authed_slack_users=authed_slack_users,
+                contacts=contacts,
+                client=client,
+                current_members=current_members,
+                auth_step=auth_step,
+            ),
+        }
+
+    # Don't bother Slack if nothing has changed since the last publish
+    view_hash = hashlib.sha256(
+        json.dumps(home_view, sort_keys=True).encode()
+    ).hexdigest()
+    # The last published hash is shared so we don't skip over a view another
+    # bot process has published since
+    if sharedState.backend.get("homes", user) == view_hash:
+        logger.debug(f"Home for {user} is unchanged, skipping publish")
+        return
+
     client.views_publish(user_id=user, view=home_view)
+    sharedState.backend.put("homes", user, view_hash)
+
+
+def schedule_home_update(user: str, config, **kwargs) -> None:
+    # Update the app home after a short delay, collapsing bursts of updates into one render
+    # kwargs are passed to update_home, the latest call's arguments win
+    delay = config["slack"].get("home_debounce", 1)
+    max_delay = config["slack"].get("home_max_delay", 5)
+
+    with home_lock:
+        now = time.monotonic()
+        pending = pending_homes.get(user)
+        if pending:
+            pending["kwargs"] = kwargs
+            # Keep pushing the update back, but not forever
+            if now - pending["first"] >= max_delay:
+                return
+            pending["timer"].cancel()
+        else:
+            pending = {"first": now, "kwargs": kwargs}
+            pending_homes[user] = pending
+
+        pending["timer"] = threading.Timer(
+            delay, run_home_update, kwargs={"user": user, "config": config}
+        )
+        pending["timer"].daemon = True
+        pending["timer"].start()
+
+
+def run_home_update(user: str, config) -> None:
+    with home_lock:
+        pending = pending_homes.pop(user, None)
+    if not pending:
+        return
+    try:
+        update_home(user=user, config=config, **pending["kwargs"])
+    except Exception:
+        logger.exception(f"Could not update home for {user}")
 
 
 def get_name(id, client: WebClient) -> str:
@@ -12,7 +12,11 @@ over_folder_limit = "`{file}` has been ignored as your butler folder is full. Yo
 over_folder_limit_admin = "<@{user}> tried to upload `{file}` but their butler folder is full. (Either more than {max_folder_files} files or a total size of more than {max_folder_size}.) It has not been saved.)"
 file_saved = "`{file}` has been saved to your butler folder. You can find it here: `{folder}/{file}`"
 file_saved_admin = "`{file}` has been saved to <@{user}>'s butler folder. They can find it here: `{folder}/{file}`"
+admin_summary = "<@{user}> has saved {count} files to their butler folder:"
+admin_summary_more = "...and {count} more"
 virus_found = "There was a problem uploading your file. Please contact a committee member for assistance."
+scan_failed = "`{file}` couldn't be checked for viruses right now so it hasn't been saved. Please try again later."
+upload_failed = "There was a problem downloading `{file}` from Slack so it hasn't been saved. Please try again later."
 virus_found_admin = "<@{user}> tried to upload `{file}` which has been flagged as a virus. (`{virus_name}`) It has not been saved."
 
 explainer = "File Butler is a service that allows you to upload files to your Member Work folder from Slack. Files you upload here will be accessible from any workstation in the space. To upload files send them to me as a message and I'll let you know when they're ready."
@@ -0,0 +1,271 @@
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any
+
+import requests
+
+from . import httpClient, sharedState
+
+# Set up logging
+
+logger = logging.getLogger("tidyhq")
+
+# The latest contact data from TidyHQ.
+# Each sync builds a new dict and swaps it in, so readers never need a lock.
+snapshot: dict[str, Any] = {
+    "contacts": [],
+    "authed_slack_users": {},
+    "current_members": {},
+}
+
+# The shared "tidyhq" generation our snapshot was built from. It's bumped every
+# time the snapshot changes, so caches built from it know to refresh
+generation = 0
+
+# When the last successful sync started, used for incremental fetches
+last_sync: datetime.datetime | None = None
+
+# Slack users that weren't found in TidyHQ, mapped to when we can look for them again
+unknown_users: dict[str, float] = {}
+
+sync_lock = threading.Lock()
+load_lock = threading.Lock()
+
+
+def get() -> dict[str, Any]:
+    # Pick up contacts synced by another process if there are newer ones
+    if sharedState.backend.shared and load_lock.acquire(blocking=False):
+        try:
+            load_shared()
+        finally:
+            load_lock.release()
+    return snapshot
+
+
+def fetch_contacts(config: dict, updated_since: datetime.datetime | None = None):
+    params = {"access_token": config["tidyhq"]["token"]}
+    if updated_since:
+        params["updated_since"] = updated_since.isoformat()
+
+    r = httpClient.get(
+        f'{config["tidyhq"].get("api_url", "https://api.tidyhq.com")}/v1/contacts/',
+        params=params,
+    )
+    r.raise_for_status()
+    contacts: list[dict[str, Any]] = r.json()
+    logger.debug(f"Received {len(contacts)} contacts")
+    return contacts
+
+
+def build_maps(
+    contacts: list[dict[str, Any]], slack_field: str
+) -> tuple[dict[Any, Any], dict[Any, Any]]:
+    authed_slack_users = {}
+    current_members = {}
+    for contact in contacts:
+        for field in contact["custom_fields"]:
+            if field["id"] == slack_field:
+                authed_slack_users[field["value"]] = contact
+                if contact["status"] != "expired":
+                    current_members[field["value"]] = contact
+    logger.debug(
+        f"Found {len(authed_slack_users)} TidyHQ contacts with associated Slack accounts"
+    )
+    logger.debug(
+        f"Found {len(current_members)} current members from associated accounts"
+    )
+
+    return authed_slack_users, current_members
+
+
+def publish(contacts: list[dict[str, Any]], config: dict) -> None:
+    global snapshot, generation
+    authed_slack_users, current_members = build_maps(
+        contacts=contacts, slack_field=config["tidyhq"]["ids"]["slack"]
+    )
+    snapshot = {
+        "contacts": contacts,
+        "authed_slack_users": authed_slack_users,
+        "current_members": current_members,
+    }
+
+    # Share the contacts with the other bot processes
+    if sharedState.backend.shared:
+        sharedState.backend.put(
+            "tidyhq",
+            "snapshot",
+            {
+                "contacts": contacts,
+                "slack_field": config["tidyhq"]["ids"]["slack"],
+                "synced_at": last_sync.isoformat() if last_sync else None,
+            },
+        )
+    generation = sharedState.backend.increment("tidyhq")
+
+    # Anyone we've just found is no longer unknown
+    for user in list(unknown_users):
+        if user in authed_slack_users:
+            unknown_users.pop(user, None)
+
+
+def load_shared() -> bool:
+    # Switch to the contacts another process published, if they're newer than ours
+    global snapshot, generation, last_sync
+    shared_generation = sharedState.backend.counters("tidyhq")[0]
+    if shared_generation == generation:
+        return False
+    saved = sharedState.backend.get("tidyhq", "snapshot")
+    if not saved:
+        return False
+
+    authed_slack_users, current_members = build_maps(
+        contacts=saved["contacts"], slack_field=saved["slack_field"]
+    )
+    snapshot = {
+        "contacts": saved["contacts"],
+        "authed_slack_users": authed_slack_users,
+        "current_members": current_members,
+    }
+    generation = shared_generation
+    if saved["synced_at"]:
+        last_sync = datetime.datetime.fromisoformat(saved["synced_at"])
+    logger.debug(f"Loaded shared TidyHQ contacts at generation {generation}")
+    return True
+
+
+def save_snapshot(config: dict) -> None:
+    # Keep a copy of the contacts on disk so the next start doesn't have to wait for TidyHQ
+    path = config["tidyhq"].get("snapshot_file", "tidyhq_contacts.json")
+    # Each process writes its own temp file in case several save at once
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(
+            {
+                "synced_at": last_sync.isoformat() if last_sync else None,
+                "contacts": snapshot["contacts"],
+            },
+            f,
+        )
+    os.replace(temp_path, path)
+
+
+def load_snapshot(config: dict) -> bool:
+    global last_sync
+    path = config["tidyhq"].get("snapshot_file", "tidyhq_contacts.json")
+    try:
+        with open(path) as f:
+            saved = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+
+    logger.info("Loaded TidyHQ contacts from snapshot")
+    with sync_lock:
+        # Incremental syncs can carry on from when the snapshot was taken,
+        # even if the first full sync after starting fails
+        if saved.get("synced_at"):
+            last_sync = datetime.datetime.fromisoformat(saved["synced_at"])
+        publish(contacts=saved["contacts"], config=config)
+    return True
+
+
+def full_sync(config: dict) -> None:
+    global last_sync
+    with sync_lock:
+        started = datetime.datetime.now(datetime.timezone.utc)
+        logger.info("Pulling TidyHQ contacts...")
+        contacts = fetch_contacts(config=config)
+        last_sync = started
+        publish(contacts=contacts, config=config)
+        save_snapshot(config=config)
+
+
+def incremental_sync(config: dict) -> None:
+    global last_sync
+    if not last_sync:
+        full_sync(config=config)
+        return
+
+    with sync_lock:
+        # Merge over the latest contacts, whichever process fetched them
+        if sharedState.backend.shared:
+            load_shared()
+        started = datetime.datetime.now(datetime.timezone.utc)
+        updated = fetch_contacts(config=config, updated_since=last_sync)
+        last_sync = started
+        if not updated:
+            return
+
+        # Merge the changed contacts over the ones we already have
+        contacts = {contact["id"]: contact for contact in snapshot["contacts"]}
+        for contact in updated:
+            contacts[contact["id"]] = contact
+        publish(contacts=list(contacts.values()), config=config)
+        save_snapshot(config=config)
+
+
+def refresh_for_unknown(user: str, config: dict) -> dict[str, Any]:
+    # Called when a Slack user isn't linked to a contact we know about.
+    # Pull any contacts that have changed since the last sync, then remember
+    # misses for a while so repeat visits don't hit TidyHQ again.
+    if unknown_users.get(user, 0) > time.monotonic():
+        return snapshot
+
+    try:
+        incremental_sync(config=config)
+    except requests.exceptions.RequestException:
+        logger.exception("Could not refresh TidyHQ contacts")
+
+    with sync_lock:
+        if user not in snapshot["authed_slack_users"]:
+            unknown_users[user] = time.monotonic() + config["tidyhq"].get(
+                "unknown_ttl", 300
+            )
+    return snapshot
+
+
+def start_sync(config: dict) -> threading.Thread:
+    # Start from contacts another process already shared, or the on-disk snapshot,
+    # and reconcile with TidyHQ in the background, otherwise load everything up front
+    # With several bot processes only the one holding the sync lease talks to TidyHQ
+    sync_interval = config["tidyhq"].get("sync_interval", 600)
+    warm_start = (sharedState.backend.shared and load_shared()) or load_snapshot(
+        config=config
+    )
+    if not warm_start:
+        full_sync(config=config)
+
+    def is_leader() -> bool:
+        return sharedState.backend.acquire_lease("tidyhq-sync", ttl=sync_interval * 3)
+
+    def sync_loop():
+        # Any error is logged and retried next time round, so the thread keeps going
+        try:
+            if warm_start and is_leader():
+                full_sync(config=config)
+        except Exception:
+            logger.exception("Could not sync TidyHQ contacts")
+        last_full = time.monotonic()
+        while True:
+            time.sleep(sync_interval)
+            try:
+                if not is_leader():
+                    continue
+                # Incremental syncs can't see deleted contacts, so do a full one occasionally
+                if (
+                    time.monotonic() - last_full
+                    >= config["tidyhq"].get("full_sync_interval", 86400)
+                ):
+                    full_sync(config=config)
+                    last_full = time.monotonic()
+                else:
+                    incremental_sync(config=config)
+            except Exception:
+                logger.exception("Could not sync TidyHQ contacts")
+
+    thread = threading.Thread(target=sync_loop, name="tidyhq-sync", daemon=True)
+    thread.start()
+    return thread
@@ -1,41 +1,35 @@
 import hashlib
 
-from . import slackUtils, formatters, fileOperators, formatters, auth
-import requests
+from . import slackUtils, formatters, fileOperators, formatters, auth, sharedState, tidyhq, virustotal
 import logging
-from typing import Any
+from typing import NamedTuple
 
 # Set up logging
 
 logger = logging.getLogger("util")
 
 
-def get_tidy_info(config: dict) -> tuple[dict[Any, Any], dict[Any, Any]]:
-    logger.info("Pulling TidyHQ contacts...")
+class Entitlements(NamedTuple):
+    multiplier: int | float
+    user_class: str
+    folder: str
 
-    contacts: list[dict[str, Any]] = requests.get(
-        "https://api.tidyhq.com/v1/contacts/",
-        params={"access_token": config["tidyhq"]["token"]},
-    ).json()
 
-    logger.debug(f"Received {len(contacts)} contacts")
+# Resolved entitlements per user are kept in the shared state backend's
+# "entitlements" namespace, along with the data generations they were resolved
+# from. An entry is only used while TidyHQ, the unlimited groups and temporary
+# auths are all unchanged.
 
-    authed_slack_users = {}
-    current_members = {}
-    for contact in contacts:
-        for field in contact["custom_fields"]:
-            if field["id"] == config["tidyhq"]["ids"]["slack"]:
-                authed_slack_users[field["value"]] = contact
-                if contact["status"] != "expired":
-                    current_members[field["value"]] = contact
-    logger.debug(
-        f"Found {len(authed_slack_users)} TidyHQ contacts with associated Slack accounts"
-    )
-    logger.debug(
-        f"Found {len(current_members)} current members from associated accounts"
-    )
 
-    return authed_slack_users, current_members
+def data_generation() -> tuple[int, ...]:
+    return sharedState.backend.counters("tidyhq", "unlimited", "auth")
+
+
+def invalidate_entitlements(user: str = "") -> None:
+    if user:
+        sharedState.backend.delete("entitlements", user)
+    else:
+        sharedState.backend.clear("entitlements")
 
 
 def check_entitlements(
@@ -46,7 +40,7 @@ def check_entitlements(
     contacts,
     app=None,
     client=None,
-):
+) -> Entitlements:
     if app:
         slack = app.client
     elif client:
@@ -54,16 +48,49 @@ def check_entitlements(
     else:
         raise Exception("Must provide either app or client")
 
-    # Refresh the info from TidyHQ if the slack user is not known at all
-    if user not in authed_slack_users_local:
+    cached = sharedState.backend.get("entitlements", user)
+    if cached and tuple(cached[0]) == data_generation():
+        return Entitlements(*cached[1])
+
+    # Taken before resolving so changes made while we work invalidate the result
+    generation = data_generation()
+    entitlements = resolve_entitlements(
+        user=user,
+        config=config,
+        authed_slack_users_local=authed_slack_users_local,
+        current_members_local=current_members_local,
+        contacts=contacts,
+        slack=slack,
+    )
+
+    # Denied users may authenticate at any moment, so always check them again
+    if entitlements.user_class == "denied":
+        return entitlements
 
-        global authed_slack_users
-        global current_members
+    # Temporary auths expire on the auth server, so only trust them as long as the auth cache does
+    if entitlements.user_class == "unregistered casual user":
+        ttl = config["auth_server"].get("cache_ttl", 30)
+    else:
+        ttl = config["download"].get("entitlement_ttl", 300)
+    sharedState.backend.put(
+        "entitlements", user, (generation, tuple(entitlements)), ttl=ttl
+    )
+    return entitlements
 
-        authed_slack_users, current_members = get_tidy_info(config)
 
-        authed_slack_users_local = authed_slack_users
-        current_members_local = current_members
+def resolve_entitlements(
+    user: str,
+    config: dict,
+    authed_slack_users_local,
+    current_members_local,
+    contacts,
+    slack,
+) -> Entitlements:
+    # Check TidyHQ for recent changes if the slack user is not known at all
+    if user not in authed_slack_users_local:
+        tidy_data = tidyhq.refresh_for_unknown(user=user, config=config)
+        authed_slack_users_local = tidy_data["authed_slack_users"]
+        current_members_local = tidy_data["current_members"]
 
     # Entitlements are checked from most to least privileged
 
@@ -91,20 +118,20 @@ def check_entitlements(
         )
     # We split off here because we don't want to check for temporary auths if we don't need to
     else:
-        temp_auths = auth.get_auths(config=config)
+        temp_auth = auth.get_auth(id=user, config=config)
         # Check if the user has an existing temporary auth
-        if user in temp_auths:
+        if temp_auth:
             multiplier = 0.5
             user_class = "unregistered casual user"
-            folder = f'{config["download"]["root_directory"]}/{config["download"]["folder_name"]}/{temp_auths[user]["name"]}.{user}/'
+            folder = f'{config["download"]["root_directory"]}/{config["download"]["folder_name"]}/{temp_auth["name"]}.{user}/'
         else:
             multiplier = 0
             user_class = "denied"
             folder = ""
-    return {"multiplier": multiplier, "user_class": user_class, "folder": folder}
+    return Entitlements(multiplier=multiplier, user_class=user_class, folder=folder)
 
 
-def is_virus(content=None, hash=None, config=None):
+def is_virus(content=None, hash=None, config=None, size=0, admin=False):
     if not config:  # type: ignore
         raise Exception("Global variable config not created")
 
@@ -126,21 +153,9 @@ def is_virus(content=None, hash=None, config=None):
     if not file_hash:
         raise Exception("File hash could not be calculated")
 
-    # Query VirusTotal
-    headers = headers = {
-        "accept": "application/json",
-        "x-apikey": config["virustotal"]["api_key"],
-    }
-
-    response = requests.get(
-        f"https://www.virustotal.com/api/v3/files/{file_hash}", headers=headers
-    ).json()
-
-    if response.get("error", None):
-        if response["error"]["code"] == "NotFoundError":
-            return False
-
-    if response["data"]["attributes"]["reputation"] < 0:
-        return response["data"]["attributes"]["meaningful_name"]
+    # Query VirusTotal, or our cache of previous answers
+    verdict = virustotal.get_verdict(
+        file_hash=file_hash, config=config, size=size, admin=admin
+    )
 
-    return False
+    return virustotal.virus_name(verdict)
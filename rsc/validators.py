@@ -5,6 +5,13 @@ from typing import Any, Literal
 
 logger = logging.getLogger("validators")
 
+# No single upload may exceed 1GB regardless of multiplier
+HARD_FILE_SIZE_LIMIT = 1000000000
+
+
+def max_file_size(config: dict, multiplier: int | float = 1) -> int | float:
+    return min(config["download"]["max_file_size"] * multiplier, HARD_FILE_SIZE_LIMIT)
+
 
 def check_size(
     id: str | Literal[None] = None,
@@ -27,7 +34,7 @@ def check_size(
         file: dict = file_object
 
     size: int = file["size"]  # type: ignore
-    if size > config["download"]["max_file_size"] * multiplier:
+    if size > max_file_size(config=config, multiplier=multiplier):
         return False
     else:
         return int(size)
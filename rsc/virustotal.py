@@ -0,0 +1,263 @@
+import itertools
+import logging
+import queue
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any
+
+import requests
+
+from . import httpClient, metrics, rateLimit
+
+# Set up logging
+
+logger = logging.getLogger("virustotal")
+
+db_lock = threading.Lock()
+initialised: set[str] = set()
+
+# Hashes waiting for a VirusTotal lookup, ordered by (priority, file size, arrival)
+scan_queue: queue.PriorityQueue = queue.PriorityQueue()
+in_flight: dict[str, Future] = {}
+queue_lock = threading.Lock()
+sequence = itertools.count()
+schedulers: list[threading.Thread] = []
+
+
+class VirusTotalError(Exception):
+    pass
+
+
+class RateLimitedError(VirusTotalError):
+    pass
+
+
+# Default number of seconds to trust each kind of verdict
+DEFAULT_TTLS = {
+    "clean": 604800,
+    "malicious": 2592000,
+    "not_found": 3600,
+}
+
+
+def connect(config: dict) -> sqlite3.Connection:
+    path = config["virustotal"].get("cache_file", "virustotal_cache.db")
+    conn = sqlite3.connect(path, timeout=30)
+    with db_lock:
+        if path not in initialised:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS verdicts (
+                    hash TEXT PRIMARY KEY,
+                    found INTEGER NOT NULL,
+                    reputation INTEGER,
+                    meaningful_name TEXT,
+                    fetched_at REAL NOT NULL
+                )"""
+            )
+            conn.commit()
+            initialised.add(path)
+    return conn
+
+
+def verdict_kind(verdict: dict[str, Any]) -> str:
+    if not verdict["found"]:
+        return "not_found"
+    if verdict["reputation"] < 0:
+        return "malicious"
+    return "clean"
+
+
+def get_cached(file_hash: str, config: dict) -> dict[str, Any] | None:
+    conn = connect(config)
+    try:
+        row = conn.execute(
+            "SELECT found, reputation, meaningful_name, fetched_at FROM verdicts WHERE hash = ?",
+            (file_hash,),
+        ).fetchone()
+    finally:
+        conn.close()
+
+    if not row:
+        return None
+
+    verdict = {
+        "found": bool(row[0]),
+        "reputation": row[1],
+        "meaningful_name": row[2],
+        "fetched_at": row[3],
+    }
+    kind = verdict_kind(verdict)
+    ttl = config["virustotal"].get("cache_ttl", {}).get(kind, DEFAULT_TTLS[kind])
+    if time.time() - verdict["fetched_at"] > ttl:
+        return None
+    return verdict
+
+
+def store(file_hash: str, verdict: dict[str, Any], config: dict) -> None:
+    conn = connect(config)
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?, ?)",
+            (
+                file_hash,
+                int(verdict["found"]),
+                verdict["reputation"],
+                verdict["meaningful_name"],
+                verdict["fetched_at"],
+            ),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def lookup(file_hash: str, config: dict) -> dict[str, Any]:
+    # Query VirusTotal directly, bypassing the cache
+    headers = {
+        "accept": "application/json",
+        "x-apikey": config["virustotal"]["api_key"],
+    }
+
+    r = httpClient.get(
+        f'{config["virustotal"].get("api_url", "https://www.virustotal.com")}/api/v3/files/{file_hash}',
+        headers=headers,
+    )
+    if r.status_code == 429:
+        raise RateLimitedError("Too many requests")
+    response = r.json()
+
+    verdict = {
+        "found": True,
+        "reputation": None,
+        "meaningful_name": None,
+        "fetched_at": time.time(),
+    }
+
+    if response.get("error", None):
+        if response["error"]["code"] == "NotFoundError":
+            verdict["found"] = False
+            return verdict
+        if response["error"]["code"] == "QuotaExceededError":
+            raise RateLimitedError(response["error"].get("message", ""))
+        raise VirusTotalError(response["error"]["code"])
+
+    verdict["reputation"] = response["data"]["attributes"]["reputation"]
+    verdict["meaningful_name"] = response["data"]["attributes"].get(
+        "meaningful_name", file_hash
+    )
+    return verdict
+
+
+def virus_name(verdict: dict[str, Any]) -> str | bool:
+    if verdict_kind(verdict) == "malicious":
+        return verdict["meaningful_name"]
+    return False
+
+
+def resolve(file_hash: str, verdict=None, error=None) -> None:
+    with queue_lock:
+        future = in_flight.pop(file_hash, None)
+    if not future or future.done():
+        return
+    if error:
+        future.set_exception(error)
+    else:
+        future.set_result(verdict)
+
+
+def run_scheduler(config: dict, bucket: rateLimit.TokenBucket) -> None:
+    max_retries = config["virustotal"].get("max_retries", 8)
+    while True:
+        priority, order, file_hash, attempt = scan_queue.get()
+
+        # Wait until we're allowed to make another request
+        bucket.acquire()
+
+        try:
+            verdict = lookup(file_hash=file_hash, config=config)
+        except (RateLimitedError, requests.exceptions.RequestException) as e:
+            if attempt >= max_retries:
+                logger.error(f"Giving up on {file_hash} after {attempt + 1} attempts")
+                resolve(file_hash=file_hash, error=e)
+                continue
+
+            # Back off exponentially with jitter, then put the hash back in line
+            delay = min(
+                config["virustotal"].get("max_backoff", 300), 2**attempt * 15
+            ) * random.uniform(0.5, 1.5)
+            if isinstance(e, RateLimitedError):
+                bucket.hold(delay)
+            logger.warning(f"Lookup for {file_hash} failed ({e}), retrying in {delay:.0f}s")
+            threading.Timer(
+                delay,
+                scan_queue.put,
+                args=((priority, order, file_hash, attempt + 1),),
+            ).start()
+            continue
+        except Exception as e:
+            logger.exception(f"Lookup for {file_hash} failed")
+            resolve(file_hash=file_hash, error=e)
+            continue
+
+        # Not being able to cache the verdict shouldn't stop anyone waiting on it
+        try:
+            store(file_hash=file_hash, verdict=verdict, config=config)
+        except Exception:
+            logger.exception(f"Could not cache the verdict for {file_hash}")
+        resolve(file_hash=file_hash, verdict=verdict)
+
+
+def start_schedulers(config: dict) -> None:
+    # Must be called with queue_lock held
+    if schedulers:
+        return
+
+    # Stay inside the VirusTotal quota (4 lookups a minute on the free tier)
+    per_minute = config["virustotal"].get("requests_per_minute", 4)
+    bucket = rateLimit.TokenBucket(rate=per_minute / 60, capacity=per_minute)
+
+    for i in range(config["virustotal"].get("scan_workers", 1)):
+        thread = threading.Thread(
+            target=run_scheduler,
+            kwargs={"config": config, "bucket": bucket},
+            name=f"virustotal-{i}",
+            daemon=True,
+        )
+        thread.start()
+        schedulers.append(thread)
+
+
+def submit(file_hash: str, config: dict, size: int = 0, admin: bool = False) -> Future:
+    # Get a verdict for a file without blocking
+    # Administrators and small files are looked up first
+    verdict = get_cached(file_hash=file_hash, config=config)
+    if verdict:
+        logger.debug(f"Using cached verdict for {file_hash}")
+        future: Future = Future()
+        future.set_result(verdict)
+        return future
+
+    with queue_lock:
+        # Identical files uploaded at the same time share a lookup
+        if file_hash in in_flight:
+            return in_flight[file_hash]
+
+        future = Future()
+        in_flight[file_hash] = future
+        metrics.queue_depth.observe(scan_queue.qsize(), queue="virustotal")
+        scan_queue.put(((0 if admin else 1, size), next(sequence), file_hash, 0))
+        start_schedulers(config=config)
+    return future
+
+
+def get_verdict(
+    file_hash: str, config: dict, size: int = 0, admin: bool = False
+) -> dict[str, Any]:
+    # Repeat uploads of the same file are answered from the cache
+    return submit(file_hash=file_hash, config=config, size=size, admin=admin).result(
+        timeout=config["virustotal"].get("verdict_timeout", 900)
+    )